@@ -1,9 +1,18 @@
+import contextlib
+import functools
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 
 from astroquery.vizier import VizierClass
-from astropy.table import Column, Table
+from astropy.coordinates import SkyCoord
+from astropy.table import Column, MaskedColumn, Table
 from astropy import units as u
 from celery.local import PromiseProxy
+from ligo.skymap.postprocess import crossmatch
+import healpy as hp
 import numpy as np
 import pkg_resources
 
@@ -12,6 +21,16 @@ from .flask import app
 
 vizier = VizierClass(row_limit=-1)
 
+LOCALIZATION_COLUMNS = ['2D CL', '3D CL', '2D pdf', '3D pdf']
+"""Columns that are filled in from the crossmatch with a localization."""
+
+INDEX_NSIDE = 64
+"""HEALPix resolution of the spatial index of the galaxy catalog."""
+
+CREDIBLE_LEVEL = 0.9
+"""Credible level of the region of a localization that is crossmatched with
+the galaxy catalog."""
+
 
 def fixup(table):
     # Add dummy 2D and 3D credible level columns.
@@ -47,7 +66,33 @@ def get_from_vizier(*args, **kwargs):
     return fixup(result)
 
 
-def get_from_package(filename):
+@contextlib.contextmanager
+def _replace(filename):
+    """Open a temporary file in binary mode to take the place of a file.
+
+    Write to a temporary file and rename it so that readers in other
+    processes never see a partially written file.
+    """
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=dirname, suffix=os.path.splitext(filename)[1],
+            delete=False) as f:
+        yield f
+    os.replace(f.name, filename)
+
+
+def _catalog_source(filename):
+    """Find a catalog in the instance path or in the package.
+
+    Returns
+    -------
+    filepath : str
+        Path of the catalog file.
+    source : dict
+        Path and modification time of the catalog file, which identify the
+        version of the catalog.
+    """
     filepath = os.path.join('catalog', filename)
     try:
         f = app.open_instance_resource(filepath)
@@ -55,11 +100,239 @@ def get_from_package(filename):
         f = pkg_resources.resource_stream(__name__, filepath)
     filepath = f.name
     f.close()
-    result = Table.read(filepath)
-    return fixup(result)
+    return filepath, {'path': filepath, 'mtime': os.path.getmtime(filepath)}
+
+
+def _catalog_directory(filename, source):
+    """Directory in the instance path for the columnar copy of one version of
+    a catalog."""
+    version = hashlib.sha1(
+        json.dumps(source, sort_keys=True).encode()).hexdigest()
+    return os.path.join(app.instance_path, 'cache', 'catalog',
+                        os.path.splitext(filename)[0], version)
+
+
+def _save_columns(table, dirname, source):
+    """Save each column of a table, and its mask, to an npy file."""
+    columns = []
+    for i, column in enumerate(table.columns.values()):
+        for kind, data in [('data', np.ma.getdata(column)),
+                           ('mask', np.ma.getmaskarray(column))]:
+            with _replace(os.path.join(
+                    dirname, '{}_{}.npy'.format(i, kind))) as f:
+                np.save(f, data)
+        columns.append({
+            'name': column.name,
+            'unit': None if column.unit is None else column.unit.to_string(),
+            'format': column.format,
+            'description': column.description})
+
+    # Write the metadata last, so that it is only present if all of the
+    # columns are.
+    with _replace(os.path.join(dirname, 'columns.json')) as f:
+        f.write(json.dumps({'source': source, 'columns': columns}).encode())
+
+
+def _load_columns(dirname, source):
+    """Memory-map a table that was saved by :func:`_save_columns`, read-only.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the table has not been saved.
+    ValueError
+        If the table was saved from a different source file.
+
+    Notes
+    -----
+    The directory is recorded in the ``directory`` key of the table's
+    metadata, so that files derived from the table can be stored with it.
+    """
+    with open(os.path.join(dirname, 'columns.json')) as f:
+        metadata = json.load(f)
+    if metadata['source'] != source:
+        raise ValueError('Catalog has been replaced')
+    return Table([
+        MaskedColumn(
+            np.load(os.path.join(dirname, '{}_data.npy'.format(i)),
+                    mmap_mode='r'),
+            mask=np.load(os.path.join(dirname, '{}_mask.npy'.format(i)),
+                         mmap_mode='r'),
+            copy=False, **column)
+        for i, column in enumerate(metadata['columns'])
+    ], masked=True, copy=False, meta={'directory': dirname})
+
+
+def get_from_package(filename):
+    """Load a catalog from the instance path or from the package.
+
+    The first time that a version of a catalog is loaded, the fixed-up table
+    is saved to one npy file per column in the instance path. After that, all
+    processes memory-map the same files read-only, so they share a single
+    copy of the catalog in the operating system's page cache instead of each
+    holding their own in memory.
+
+    Each version of the catalog gets its own directory, which is written
+    privately and then published by renaming it, so that files are never
+    removed or replaced while other processes may be using them.
+    """
+    filepath, source = _catalog_source(filename)
+    dirname = _catalog_directory(filename, source)
+    try:
+        return _load_columns(dirname, source)
+    except FileNotFoundError:
+        pass
+
+    parent = os.path.dirname(dirname)
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix='.')
+    try:
+        _save_columns(fixup(Table.read(filepath)), tmpdir, source)
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError:
+            # Another process has already published this version.
+            pass
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return _load_columns(dirname, source)
 
 
 twomass = PromiseProxy(get_from_vizier, ('J/ApJS/199/26/table3',))
 
 
 galaxies = clu = PromiseProxy(get_from_package, ('CLU.hdf5',))
+
+
+@functools.lru_cache()
+def get_index():
+    """Get the HEALPix index of the galaxy catalog.
+
+    The index is stored next to the columnar copy of the catalog in the
+    instance path.
+
+    Returns
+    -------
+    order : numpy.ndarray
+        Row indices of the galaxies, sorted by NESTED HEALPix pixel index at
+        a resolution of :data:`INDEX_NSIDE`.
+    offsets : numpy.ndarray
+        Offsets into ``order`` of the galaxies in each pixel: the galaxies in
+        pixel ``i`` are ``order[offsets[i]:offsets[i + 1]]``.
+    """
+    filename = os.path.join(galaxies.meta['directory'], 'index.npz')
+    try:
+        with np.load(filename) as data:
+            return data['order'], data['offsets']
+    except FileNotFoundError:
+        pass
+
+    ipix = hp.ang2pix(INDEX_NSIDE, np.asarray(galaxies['ra']),
+                      np.asarray(galaxies['dec']), nest=True, lonlat=True)
+    order = np.argsort(ipix, kind='stable')
+    offsets = np.searchsorted(
+        ipix[order], np.arange(hp.nside2npix(INDEX_NSIDE) + 1))
+    with _replace(filename) as f:
+        np.savez(f, order=order, offsets=offsets)
+    return order, offsets
+
+
+def galaxies_in_region(region):
+    """Find the galaxies within a region of the sky.
+
+    Only the galaxies in the pixels of the index that overlap the region are
+    tested individually.
+
+    Parameters
+    ----------
+    region : numpy.ndarray
+        Boolean HEALPix map in RING ordering that is true inside the region.
+        Its resolution must be at least :data:`INDEX_NSIDE`.
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted row indices of the galaxies in the region.
+    """
+    order, offsets = get_index()
+    nside = hp.npix2nside(len(region))
+    shift = 2 * (hp.nside2order(nside) - hp.nside2order(INDEX_NSIDE))
+    coarse = np.unique(hp.ring2nest(nside, np.flatnonzero(region)) >> shift)
+
+    # Concatenate the ranges of rows in each of the coarse pixels.
+    starts = offsets[coarse]
+    lengths = offsets[coarse + 1] - starts
+    rows = order[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+                 np.arange(lengths.sum())]
+
+    ipix = hp.ang2pix(nside, np.asarray(galaxies['ra'])[rows],
+                      np.asarray(galaxies['dec'])[rows], lonlat=True)
+    return np.sort(rows[region[ipix]])
+
+
+def write_galaxies(filename, rows):
+    """Write some of the galaxies to an HDF5 file in the format of the
+    original catalog, for example for gwemopt to read.
+
+    Parameters
+    ----------
+    filename : str
+        The output filename.
+    rows : numpy.ndarray
+        Row indices of the galaxies to write.
+    """
+    names = [name for name in galaxies.colnames
+             if name not in LOCALIZATION_COLUMNS]
+    columns = [np.ma.getdata(galaxies[name])[rows] for name in names]
+    columns = [np.char.encode(column) if column.dtype.kind == 'U' else column
+               for column in columns]
+    Table(columns, names=names).write(filename, path='catalog')
+
+
+def get_crossmatch(localization):
+    """Crossmatch the galaxy catalog with a localization.
+
+    Only galaxies within the :data:`CREDIBLE_LEVEL` credible region are
+    crossmatched. The results are cached on disk, so the crossmatch is only
+    calculated once per localization.
+
+    Parameters
+    ----------
+    localization : growth.too.models.Localization
+        The localization.
+
+    Returns
+    -------
+    dict
+        Arrays of the 2D and 3D searched probability and probability density
+        of each galaxy, keyed by the field names of
+        :class:`ligo.skymap.postprocess.crossmatch.CrossmatchResult`. The
+        values are NaN for galaxies outside of the credible region.
+    """
+    filename = localization._crossmatch_cache_filename('CLU')
+    keys = ['searched_prob', 'searched_prob_vol',
+            'probdensity', 'probdensity_vol']
+    try:
+        with np.load(filename) as data:
+            result = {key: data[key] for key in keys}
+    except FileNotFoundError:
+        pass
+    else:
+        # Recalculate if the catalog has been replaced.
+        if all(len(value) == len(galaxies) for value in result.values()):
+            return result
+
+    rows = galaxies_in_region(
+        localization.credible_levels_2d <= CREDIBLE_LEVEL)
+    result = {key: np.full(len(galaxies), np.nan) for key in keys}
+    if len(rows) > 0:
+        crossmatch_result = crossmatch(
+            localization.table,
+            SkyCoord(galaxies['ra'][rows], galaxies['dec'][rows],
+                     galaxies['distmpc'][rows]))
+        for key in keys:
+            result[key][rows] = getattr(crossmatch_result, key)
+
+    with _replace(filename) as f:
+        np.savez(f, **result)
+    return result
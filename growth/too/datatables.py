@@ -0,0 +1,262 @@
+"""
+Server-side processing of DataTables requests.
+
+See https://datatables.net/manual/server-side for a description of the
+protocol.
+"""
+
+import datetime
+import json
+import operator
+import re
+
+import numpy as np
+from sqlalchemy import func
+
+__all__ = ('process', 'process_query')
+
+_FLOAT_FORMAT = re.compile(r'%[-+ 0#]*\d*\.(\d+)[fF]')
+
+
+def _get_int(args, key):
+    try:
+        value = args[key]
+    except KeyError:
+        return None
+    return int(value)
+
+
+def _data_and_mask(column):
+    """Split a (masked) column into a plain array and a mask that is true for
+    missing values."""
+    data = np.asarray(np.ma.getdata(column))
+    mask = np.ma.getmaskarray(column)
+    if data.dtype.kind == 'f':
+        mask = mask | np.isnan(data)
+    return data, mask
+
+
+def _sort_key(data, mask, descending):
+    """Get a floating point array that sorts in the same order as a column.
+    Missing values are always sorted last."""
+    if data.dtype.kind in 'biuf':
+        key = data.astype(float)
+    else:
+        _, key = np.unique(data, return_inverse=True)
+        key = key.astype(float)
+    if descending:
+        key = -key
+    key[mask] = np.inf
+    return key
+
+
+def _to_json(column, data, mask):
+    """Convert a column to a list of JSON-serializable values."""
+    if data.dtype.kind == 'f':
+        match = _FLOAT_FORMAT.fullmatch(getattr(column, 'format', None) or '')
+        if match:
+            data = np.round(data, int(match.group(1)))
+    elif data.dtype.kind == 'M':
+        data = np.datetime_as_string(data)
+    values = data.tolist()
+    for i in np.flatnonzero(mask):
+        values[i] = None
+    return values
+
+
+def _get_search(args, i):
+    """Get the filter of a column as a dictionary, or an empty dictionary if
+    the column is not filtered."""
+    try:
+        search = json.loads(
+            args['columns[{}][search][value]'.format(i)] or '{}')
+    except (KeyError, ValueError):
+        return {}
+    if not isinstance(search, dict):
+        return {}
+    return search
+
+
+def process(columns, args):
+    """Filter, sort, and page through a table in response to a DataTables
+    server-side processing request.
+
+    Each column may be filtered by a JSON object with optional ``min`` and
+    ``max`` keys in its search value. Missing values never match a filter and
+    always sort last. When sorting by a single column, only the rows up to the
+    end of the requested page are fully sorted.
+
+    Parameters
+    ----------
+    columns : list
+        The columns of the table, as Numpy arrays, masked arrays, or astropy
+        columns. A column's ``format`` attribute, if any, sets the number of
+        decimal places of floating point values in the response.
+    args : dict
+        The request arguments.
+
+    Returns
+    -------
+    dict
+        The response, ready to be serialized as JSON.
+
+    Raises
+    ------
+    ValueError
+        If the request arguments are malformed.
+    """
+    arrays = [_data_and_mask(column) for column in columns]
+    nrows = len(arrays[0][0]) if arrays else 0
+    result = {'recordsTotal': nrows}
+
+    draw = _get_int(args, 'draw')
+    if draw is not None:
+        result['draw'] = draw
+
+    # Filter.
+    keep = np.ones(nrows, dtype=bool)
+    for i, (data, mask) in enumerate(arrays):
+        search = _get_search(args, i)
+        for key, op in [('min', operator.ge), ('max', operator.le)]:
+            try:
+                bound = search[key]
+            except KeyError:
+                continue
+            bound = np.asarray(bound, dtype=data.dtype)
+            keep &= ~mask & op(data, bound)
+    index = np.flatnonzero(keep)
+    result['recordsFiltered'] = len(index)
+
+    # Build sort keys, most significant first.
+    keys = []
+    for i in range(len(arrays)):
+        column = _get_int(args, 'order[{}][column]'.format(i))
+        if column is None:
+            break
+        if not 0 <= column < len(arrays):
+            raise ValueError('invalid column index: {}'.format(column))
+        data, mask = arrays[column]
+        descending = args.get('order[{}][dir]'.format(i)) == 'desc'
+        keys.append(_sort_key(data[index], mask[index], descending))
+
+    # Sort and page.
+    start = max(_get_int(args, 'start') or 0, 0)
+    length = _get_int(args, 'length')
+    if length is None or length < 0:
+        stop = len(index)
+    else:
+        stop = min(start + length, len(index))
+    if start >= stop:
+        index = index[:0]
+    elif not keys:
+        index = index[start:stop]
+    elif len(keys) == 1 and stop < len(index):
+        key, = keys
+        # Restore the original order before sorting so that ties are
+        # broken in the same way as by a full sort.
+        top = np.sort(np.argpartition(key, stop - 1)[:stop])
+        top = top[np.argsort(key[top], kind='stable')]
+        index = index[top[start:]]
+    else:
+        index = index[np.lexsort(keys[::-1])[start:stop]]
+
+    result['data'] = list(zip(*(
+        _to_json(column, data[index], mask[index])
+        for column, (data, mask) in zip(columns, arrays))))
+    return result
+
+
+def _sql_dtype(column):
+    """Get the Numpy data type of the values of an SQL column expression."""
+    python_type = column.type.python_type
+    if issubclass(python_type, datetime.datetime):
+        return np.dtype('datetime64[us]')
+    return np.dtype(python_type)
+
+
+def _sql_to_json(value):
+    """Convert a value from a database row to a JSON-serializable value."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def process_query(query, columns, args, order_by=()):
+    """Filter, sort, and page through the results of a database query in
+    response to a DataTables server-side processing request.
+
+    This is the same as :func:`process`, except that the rows are filtered,
+    sorted, and paged by the database, so only the rows on the requested page
+    are ever fetched.
+
+    Parameters
+    ----------
+    query : sqlalchemy.orm.query.Query
+        The query that selects the rows of the table.
+    columns : list
+        The columns of the table, as SQL column expressions.
+    args : dict
+        The request arguments.
+    order_by : list
+        SQL expressions that set the order of the rows when the table is not
+        sorted, and break ties when it is.
+
+    Returns
+    -------
+    dict
+        The response, ready to be serialized as JSON.
+
+    Raises
+    ------
+    ValueError
+        If the request arguments are malformed.
+    """
+    # NaN is stored for missing floating point values in some columns; treat
+    # it like NULL, so that it never matches a filter and always sorts last.
+    dtypes = [_sql_dtype(column) for column in columns]
+    columns = [
+        func.nullif(column, float('nan'), type_=column.type)
+        if dtype.kind == 'f' else column
+        for column, dtype in zip(columns, dtypes)]
+    result = {'recordsTotal': query.order_by(None).count()}
+
+    draw = _get_int(args, 'draw')
+    if draw is not None:
+        result['draw'] = draw
+
+    # Filter.
+    for i, (column, dtype) in enumerate(zip(columns, dtypes)):
+        search = _get_search(args, i)
+        for key, op in [('min', operator.ge), ('max', operator.le)]:
+            try:
+                bound = search[key]
+            except KeyError:
+                continue
+            bound = np.asarray(bound, dtype=dtype).item()
+            query = query.filter(op(column, bound))
+    result['recordsFiltered'] = query.order_by(None).count()
+
+    # Build sort keys, most significant first.
+    keys = []
+    for i in range(len(columns)):
+        column = _get_int(args, 'order[{}][column]'.format(i))
+        if column is None:
+            break
+        if not 0 <= column < len(columns):
+            raise ValueError('invalid column index: {}'.format(column))
+        descending = args.get('order[{}][dir]'.format(i)) == 'desc'
+        column = columns[column]
+        keys.append(
+            (column.desc() if descending else column.asc()).nullslast())
+
+    # Sort and page.
+    query = query.order_by(None).order_by(*keys, *order_by)
+    start = max(_get_int(args, 'start') or 0, 0)
+    length = _get_int(args, 'length')
+    query = query.offset(start)
+    if length is not None and length >= 0:
+        query = query.limit(length)
+
+    result['data'] = [tuple(_sql_to_json(value) for value in row)
+                      for row in query.with_entities(*columns)]
+    return result
@@ -42,6 +42,10 @@ app.config['MAIL_USE_TLS'] = True
 app.config['MAIL_DEFAULT_SENDER'] = '{}@gmail.com'.format(
     app.config['MAIL_USERNAME'])
 
+# Set to True to write a cProfile file for every observing plan to the
+# instance directory.
+app.config['PROFILE_PLANS'] = False
+
 # Apply instance configuration from application.cfg and application.cfg.d/*.
 app.config.from_pyfile('application.cfg', silent=True)
 dropin_dir = os.path.join(app.instance_path, 'application.cfg.d')
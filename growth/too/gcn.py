@@ -207,7 +207,9 @@ def handle(payload, root):
                         )
                         for tele in models.Telescope.query
                     ),
-                    tasks.skymaps.contour.s(dateobs)
+                    tasks.skymaps.contour.s(dateobs),
+                    tasks.skymaps.crossmatch_galaxies.s(dateobs),
+                    tasks.skymaps.render_plots.s(dateobs)
                 )
             ).delay()
 
@@ -2,10 +2,19 @@
 Database schema.
 """
 
+import contextlib
 import datetime
 import enum
+import functools
+import itertools
+import multiprocessing
 import os
+import shutil
 import copy
+import tempfile
+import time
+import urllib.parse
+import zlib
 import gwemopt.utils
 import gwemopt.ztf_tiling
 
@@ -17,13 +26,16 @@ from flask_login.mixins import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 import gcn
 import healpy as hp
-from ligo.skymap.postprocess import find_greedy_credible_levels
+from ligo.skymap.postprocess import crossmatch, find_greedy_credible_levels
 from ligo.skymap.bayestar import rasterize
 import lxml.etree
 import pkg_resources
 import numpy as np
+from scipy import sparse
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
 from sqlalchemy_utils import EmailType, PhoneNumberType
 from tqdm import tqdm
 
@@ -32,6 +44,50 @@ from .flask import app
 db = SQLAlchemy(app)
 
 
+class NumpyArray(db.TypeDecorator):
+    """Store a one-dimensional Numpy array as raw bytes.
+
+    Parameters
+    ----------
+    dtype : str
+        Numpy data type of the stored array. Use an explicit byte order
+        (e.g. ``'<f8'``) so that the stored bytes are platform independent.
+        Use a 32-bit type like ``'<f4'`` to halve the storage size at the
+        cost of precision.
+    compress : bool
+        If True, compress the data with zlib.
+    """
+
+    impl = db.LargeBinary
+
+    cache_ok = True
+
+    def __init__(self, dtype, compress=False):
+        super().__init__()
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        value = np.ascontiguousarray(value, dtype=self.dtype).tobytes()
+        if self.compress:
+            value = zlib.compress(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if self.compress:
+            value = zlib.decompress(value)
+        return np.frombuffer(value, dtype=self.dtype)
+
+    def compare_values(self, x, y):
+        if x is None or y is None:
+            return x is y
+        return np.array_equal(x, y)
+
+
 def get_ztf_quadrants():
     """Calculate ZTF quadrant footprints as offsets from the telescope
     boresight."""
@@ -47,7 +103,87 @@ def get_ztf_quadrants():
     return np.transpose(offsets, (2, 0, 1))
 
 
-def create_all():
+def bulk_upsert(model, rows, chunksize=1000):
+    """Insert many rows at once, updating any existing rows with the same
+    primary key.
+
+    Parameters
+    ----------
+    model : db.Model
+        The model class.
+    rows : iterable
+        Dictionaries of column values. All dictionaries must have the same
+        keys, and must include the primary key columns.
+    chunksize : int
+        Number of rows to write per statement.
+
+    Returns
+    -------
+    count : int
+        The number of rows written.
+    """
+    table = model.__table__
+    primary_key = [column.name for column in table.primary_key]
+    count = 0
+
+    # Make sure that any pending ORM changes (e.g., parent rows that are
+    # referenced by foreign keys) are written first.
+    db.session.flush()
+
+    rows = iter(rows)
+    for chunk in iter(lambda: list(itertools.islice(rows, chunksize)), []):
+        # A single statement may not affect the same row twice, so keep
+        # only the last of any rows with duplicate primary keys.
+        chunk = list({tuple(row[key] for key in primary_key): row
+                      for row in chunk}.values())
+        statement = postgresql.insert(table).values(chunk)
+        update_columns = [key for key in chunk[0] if key not in primary_key]
+        if update_columns:
+            statement = statement.on_conflict_do_update(
+                index_elements=primary_key,
+                set_={key: statement.excluded[key] for key in update_columns})
+        else:
+            statement = statement.on_conflict_do_nothing(
+                index_elements=primary_key)
+        db.session.execute(statement)
+        count += len(chunk)
+    return count
+
+
+def _get_field_footprint(args):
+    """Calculate the HEALPix pixels and the outline of a field."""
+    ra, dec, fov_type, fov = args
+    if fov_type == "square":
+        ipix, radecs, patch, area = gwemopt.utils.getSquarePixels(
+            ra, dec, fov, Localization.nside)
+    elif fov_type == "circle":
+        ipix, radecs, patch, area = gwemopt.utils.getCirclePixels(
+            ra, dec, fov, Localization.nside)
+    if len(radecs) == 0:
+        return None
+    corners = np.vstack((radecs, radecs[0, :]))
+    if corners.size == 10:
+        corners_copy = copy.deepcopy(corners)
+        corners[2] = corners_copy[3]
+        corners[3] = corners_copy[2]
+    return ipix.tolist(), corners.tolist()
+
+
+def _query_polygons(xyzs):
+    """Calculate the HEALPix pixels inside each of several polygons."""
+    return [hp.query_polygon(Localization.nside, xyz).tolist()
+            for xyz in xyzs]
+
+
+def create_all(processes=1):
+    """Create all tables and populate telescopes, fields, and subfields.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of worker processes used to calculate field footprints. If
+        None, then use one process per CPU.
+    """
     db.create_all(bind=None)
     telescopes = ["ZTF", "Gattini", "DECam", "KPED", "GROWTH-India"]
     available_filters = {"ZTF": ["g", "r", "i"],
@@ -164,131 +300,362 @@ def create_all():
         }
     }
 
-    with tqdm(telescopes) as telescope_progress:
-        for tele in telescope_progress:
-            telescope_progress.set_description('populating {}'.format(tele))
-
-            filename = pkg_resources.resource_filename(
-                __name__, 'input/%s.ref' % tele)
-            if os.path.isfile(filename):
-                refstable = table.Table.read(
-                    filename, format='ascii', data_start=2, data_end=-1)
-                refs = table.unique(refstable, keys=['field', 'fid'])
-                if "maglimcat" not in refs.columns:
-                    refs["maglimcat"] = np.nan
-
-                reference_images = {
-                    group[0]['field']: group['fid'].astype(int).tolist()
-                    for group in refs.group_by('field').groups}
-                reference_mags = {
-                    group[0]['field']: group['maglimcat'].tolist()
-                    for group in refs.group_by('field').groups}
-
+    with contextlib.ExitStack() as stack:
+        if processes == 1:
+            imap = map
+        else:
+            pool = stack.enter_context(multiprocessing.Pool(processes))
+            imap = functools.partial(pool.imap, chunksize=16)
+
+        with tqdm(telescopes) as telescope_progress:
+            for tele in telescope_progress:
+                telescope_progress.set_description(
+                    'populating {}'.format(tele))
+                start_time = time.perf_counter()
+                _create_telescope(tele, available_filters[tele],
+                                  plan_args[tele], imap)
+                telescope_progress.write('populated {} in {:.1f} s'.format(
+                    tele, time.perf_counter() - start_time))
+
+
+def _create_telescope(tele, filters, default_plan_args, imap):
+    """Populate one telescope and its fields and subfields."""
+    filename = pkg_resources.resource_filename(
+        __name__, 'input/%s.ref' % tele)
+    if os.path.isfile(filename):
+        refstable = table.Table.read(
+            filename, format='ascii', data_start=2, data_end=-1)
+        refs = table.unique(refstable, keys=['field', 'fid'])
+        if "maglimcat" not in refs.columns:
+            refs["maglimcat"] = np.nan
+
+        reference_images = {
+            group[0]['field']: group['fid'].astype(int).tolist()
+            for group in refs.group_by('field').groups}
+        reference_mags = {
+            group[0]['field']: group['maglimcat'].tolist()
+            for group in refs.group_by('field').groups}
+
+    else:
+        reference_images = {}
+        reference_mags = {}
+
+    tesspath = 'input/%s.tess' % tele
+    try:
+        tessfile = app.open_instance_resource(tesspath)
+    except IOError:
+        tessfile = pkg_resources.resource_stream(__name__, tesspath)
+    tessfilename = tessfile.name
+    tessfile.close()
+    fields = np.recfromtxt(
+        tessfilename, usecols=range(3),
+        names=['field_id', 'ra', 'dec'])
+
+    with pkg_resources.resource_stream(
+            __name__, 'config/%s.config' % tele) as g:
+        config_struct = {}
+        for line in g.readlines():
+            line_without_return = line.decode().split("\n")
+            line_split = line_without_return[0].split(" ")
+            line_split = list(filter(None, line_split))
+            if line_split:
+                try:
+                    config_struct[line_split[0]] = float(line_split[1])
+                except ValueError:
+                    config_struct[line_split[0]] = line_split[1]
+
+    db.session.merge(Telescope(telescope=tele,
+                               lat=config_struct["latitude"],
+                               lon=config_struct["longitude"],
+                               elevation=config_struct["elevation"],
+                               timezone=config_struct["timezone"],
+                               filters=filters,
+                               default_plan_args=default_plan_args))
+
+    bands = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
+
+    def field_rows():
+        footprints = imap(_get_field_footprint, (
+            (float(ra), float(dec),
+             config_struct["FOV_type"], config_struct["FOV"])
+            for _, ra, dec in fields))
+        for (field_id, ra, dec), footprint in zip(
+                tqdm(fields, 'populating fields'), footprints):
+            if footprint is None:
+                continue
+            ipix, corners = footprint
+            ref_filter_ids = reference_images.get(field_id, [])
+            ref_filter_mags = reference_mags.get(field_id, [])
+            ref_filter_bands = [bands.get(n, n) for n in ref_filter_ids]
+            contour = {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'MultiLineString',
+                    'coordinates': [corners]
+                },
+                'properties': {
+                    'telescope': tele,
+                    'field_id': int(field_id),
+                    'ra': float(ra),
+                    'dec': float(dec),
+                    'depth': dict(zip(ref_filter_bands, ref_filter_mags))
+                }
+            }
+            yield dict(telescope=tele,
+                       field_id=int(field_id),
+                       ra=float(ra), dec=float(dec), contour=contour,
+                       reference_filter_ids=ref_filter_ids,
+                       reference_filter_mags=ref_filter_mags,
+                       ipix=ipix)
+
+    bulk_upsert(Field, field_rows())
+    _after_commit(db.session(), _invalidate_coverage, tele, 'field_table')
+
+    if tele == "ZTF":
+        quadrant_coords = get_ztf_quadrants()
+
+        skyoffset_frames = coordinates.SkyCoord(
+            fields['ra'], fields['dec'], unit=u.deg
+        ).skyoffset_frame()
+
+        quadrant_coords_icrs = coordinates.SkyCoord(
+            *np.tile(
+                quadrant_coords[:, np.newaxis, ...],
+                (len(fields), 1, 1)), unit=u.deg,
+            frame=skyoffset_frames[:, np.newaxis, np.newaxis]
+        ).transform_to(coordinates.ICRS)
+
+        quadrant_xyz = np.moveaxis(
+            quadrant_coords_icrs.cartesian.xyz.value, 0, -1)
+
+        def subfield_rows():
+            for field_id, ipixs in zip(
+                    tqdm(fields['field_id'], 'populating subfields'),
+                    imap(_query_polygons, quadrant_xyz)):
+                for ii, ipix in enumerate(ipixs):
+                    yield dict(telescope=tele,
+                               field_id=int(field_id),
+                               subfield_id=ii,
+                               ipix=ipix)
+
+        bulk_upsert(SubField, subfield_rows())
+
+
+class CoverageMatrix:
+    """Sparse matrix of the HEALPix pixels that are covered by a collection of
+    fields.
+
+    There is one row for each field, and one column for each HEALPix pixel at
+    resolution :attr:`Localization.nside` in RING ordering.
+
+    Parameters
+    ----------
+    keys : list
+        Field IDs labeling the rows.
+    matrix : scipy.sparse.csr_matrix
+        Boolean pixel membership matrix.
+    """
+
+    def __init__(self, keys, matrix):
+        self.keys = keys
+        self.matrix = matrix
+        self._rows = {key: row for row, key in enumerate(keys)}
+
+    @classmethod
+    def from_ipix(cls, keys, ipixs):
+        """Build the matrix from lists of pixel indices for each row."""
+        ipixs = [np.asarray(ipix or [], dtype=np.int64) for ipix in ipixs]
+        indptr = np.cumsum([0] + [len(ipix) for ipix in ipixs])
+        indices = np.concatenate([np.empty(0, dtype=np.int64)] + ipixs)
+        return cls(keys, cls._make_matrix(indices, indptr))
+
+    @staticmethod
+    def _make_matrix(indices, indptr):
+        npix = hp.nside2npix(Localization.nside)
+        return sparse.csr_matrix(
+            (np.ones(len(indices), dtype=bool), indices, indptr),
+            shape=(len(indptr) - 1, npix))
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            return cls(data['keys'].tolist(),
+                       cls._make_matrix(data['indices'], data['indptr']))
+
+    def save(self, file):
+        np.savez(file, keys=np.asarray(self.keys, dtype=np.int64),
+                 indices=self.matrix.indices, indptr=self.matrix.indptr)
+
+    def rows(self, keys):
+        """Get the row indices for the given keys, skipping unknown keys."""
+        return np.asarray([self._rows[key] for key in keys
+                           if key in self._rows], dtype=np.intp)
+
+    def ipix(self, keys):
+        """Get the sorted union of the pixels covered by the given keys."""
+        return np.unique(self.matrix[self.rows(keys)].indices)
+
+    def ipix_rows(self, keys):
+        """Get the pixels covered by each of the given keys, as a list of
+        arrays. Unknown keys cover no pixels."""
+        indices, indptr = self.matrix.indices, self.matrix.indptr
+        result = []
+        for key in keys:
+            row = self._rows.get(key)
+            if row is None:
+                result.append(indices[:0])
             else:
-                reference_images = {}
-                reference_mags = {}
+                result.append(indices[indptr[row]:indptr[row + 1]])
+        return result
+
+    def unions(self, groups):
+        """Get the union of the pixels covered by each of several groups of
+        keys, as a boolean sparse matrix with one row per group."""
+        rows = [self.rows(keys) for keys in groups]
+        group_index = np.repeat(
+            np.arange(len(groups)), [len(row) for row in rows])
+        rows = np.concatenate(rows + [np.empty(0, dtype=np.intp)])
+        incidence = sparse.csr_matrix(
+            (np.ones(len(rows)), (group_index, rows)),
+            shape=(len(groups), self.matrix.shape[0]))
+        return (incidence @ self.matrix).astype(bool)
+
+    def area(self, keys):
+        """Get the area in square degrees covered by the given keys."""
+        return hp.nside2pixarea(Localization.nside, degrees=True) * len(
+            self.ipix(keys))
+
+    def probability(self, keys, prob):
+        """Get the probability enclosed by the union of the given keys."""
+        return prob[self.ipix(keys)].sum()
+
+    def probabilities(self, prob):
+        """Get the probability enclosed by each row individually."""
+        return self.matrix @ prob
+
+
+class FieldTable(CoverageMatrix):
+    """Coverage matrix of the fields of a telescope that also holds the
+    positions and reference filters of the fields, for looking up many fields
+    at once without querying the database.
+
+    Parameters
+    ----------
+    keys : list
+        Field IDs labeling the rows.
+    matrix : scipy.sparse.csr_matrix
+        Boolean pixel membership matrix.
+    ra, dec : numpy.ndarray
+        Coordinates of the field centers in degrees.
+    reference_filters : numpy.ndarray
+        Bit masks of the reference filter IDs of the fields: bit ``i`` is set
+        if the field has a reference image in the filter with ID ``i``.
+    """
+
+    def __init__(self, keys, matrix, ra, dec, reference_filters):
+        super().__init__(keys, matrix)
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.reference_filters = np.asarray(reference_filters, dtype=np.int64)
+
+    @classmethod
+    def from_fields(cls, field_ids, ras, decs, reference_filter_ids, ipixs):
+        """Build the table from lists of the attributes of each field."""
+        coverage = CoverageMatrix.from_ipix(field_ids, ipixs)
+        reference_filters = [
+            sum(1 << filter_id for filter_id in set(filter_ids or ()))
+            for filter_ids in reference_filter_ids]
+        return cls(coverage.keys, coverage.matrix, ras, decs,
+                   reference_filters)
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            return cls(data['keys'].tolist(),
+                       cls._make_matrix(data['indices'], data['indptr']),
+                       data['ra'], data['dec'], data['reference_filters'])
+
+    def save(self, file):
+        np.savez(file, keys=np.asarray(self.keys, dtype=np.int64),
+                 indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 ra=self.ra, dec=self.dec,
+                 reference_filters=self.reference_filters)
+
+    def find(self, keys):
+        """Get the row indices for the given field IDs, or -1 for unknown
+        field IDs."""
+        return np.asarray([self._rows.get(key, -1) for key in keys],
+                          dtype=np.intp)
+
+    def has_reference(self, rows, filter_id):
+        """Determine whether the fields in the given rows have reference
+        images in a filter."""
+        return (self.reference_filters[rows] >> filter_id) & 1 != 0
+
+
+_coverage_matrices = {}
+
+
+def _coverage_cache_filename(telescope, kind):
+    return os.path.join(
+        app.instance_path, 'cache', 'coverage', '{}_{}_{}.npz'.format(
+            urllib.parse.quote(telescope, safe=''), kind, Localization.nside))
+
+
+def _get_coverage(telescope, kind, build, cls=CoverageMatrix):
+    """Load a coverage matrix from the per-process cache or the on-disk cache,
+    or build it by calling ``build`` and store it in the on-disk cache."""
+    filename = _coverage_cache_filename(telescope, kind)
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        result = build()
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                dir=dirname, suffix='.npz', delete=False) as f:
+            result.save(f)
+        os.replace(f.name, filename)
+        mtime = os.stat(filename).st_mtime_ns
+    else:
+        try:
+            cached_mtime, result = _coverage_matrices[filename]
+        except KeyError:
+            cached_mtime = None
+        if cached_mtime != mtime:
+            result = cls.load(filename)
+    _coverage_matrices[filename] = mtime, result
+    return result
 
-            tesspath = 'input/%s.tess' % tele
-            try:
-                tessfile = app.open_instance_resource(tesspath)
-            except IOError:
-                tessfile = pkg_resources.resource_stream(__name__, tesspath)
-            tessfilename = tessfile.name
-            tessfile.close()
-            fields = np.recfromtxt(
-                tessfilename, usecols=range(3),
-                names=['field_id', 'ra', 'dec'])
-
-            with pkg_resources.resource_stream(
-                    __name__, 'config/%s.config' % tele) as g:
-                config_struct = {}
-                for line in g.readlines():
-                    line_without_return = line.decode().split("\n")
-                    line_split = line_without_return[0].split(" ")
-                    line_split = list(filter(None, line_split))
-                    if line_split:
-                        try:
-                            config_struct[line_split[0]] = float(line_split[1])
-                        except ValueError:
-                            config_struct[line_split[0]] = line_split[1]
-
-            db.session.merge(Telescope(telescope=tele,
-                                       lat=config_struct["latitude"],
-                                       lon=config_struct["longitude"],
-                                       elevation=config_struct["elevation"],
-                                       timezone=config_struct["timezone"],
-                                       filters=available_filters[tele],
-                                       default_plan_args=plan_args[tele]))
-
-            for field_id, ra, dec in tqdm(fields, 'populating fields'):
-                ref_filter_ids = reference_images.get(field_id, [])
-                ref_filter_mags = []
-                for val in reference_mags.get(field_id, []):
-                    ref_filter_mags.append(val)
-                bands = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
-                ref_filter_bands = [bands.get(n, n) for n
-                                    in ref_filter_ids]
-
-                if config_struct["FOV_type"] == "square":
-                    ipix, radecs, patch, area = gwemopt.utils.getSquarePixels(
-                        ra, dec, config_struct["FOV"], Localization.nside)
-                elif config_struct["FOV_type"] == "circle":
-                    ipix, radecs, patch, area = gwemopt.utils.getCirclePixels(
-                        ra, dec, config_struct["FOV"], Localization.nside)
-                if len(radecs) == 0:
-                    continue
-                corners = np.vstack((radecs, radecs[0, :]))
-                if corners.size == 10:
-                    corners_copy = copy.deepcopy(corners)
-                    corners[2] = corners_copy[3]
-                    corners[3] = corners_copy[2]
-                contour = {
-                    'type': 'Feature',
-                    'geometry': {
-                        'type': 'MultiLineString',
-                        'coordinates': [corners.tolist()]
-                    },
-                    'properties': {
-                        'telescope': tele,
-                        'field_id': int(field_id),
-                        'ra': ra,
-                        'dec': dec,
-                        'depth': dict(zip(ref_filter_bands, ref_filter_mags))
-                    }
-                }
-                db.session.merge(Field(telescope=tele,
-                                       field_id=int(field_id),
-                                       ra=ra, dec=dec, contour=contour,
-                                       reference_filter_ids=ref_filter_ids,
-                                       reference_filter_mags=ref_filter_mags,
-                                       ipix=ipix.tolist()))
-
-            if tele == "ZTF":
-                quadrant_coords = get_ztf_quadrants()
-
-                skyoffset_frames = coordinates.SkyCoord(
-                    fields['ra'], fields['dec'], unit=u.deg
-                ).skyoffset_frame()
-
-                quadrant_coords_icrs = coordinates.SkyCoord(
-                    *np.tile(
-                        quadrant_coords[:, np.newaxis, ...],
-                        (len(fields), 1, 1)), unit=u.deg,
-                    frame=skyoffset_frames[:, np.newaxis, np.newaxis]
-                ).transform_to(coordinates.ICRS)
-
-                quadrant_xyz = np.moveaxis(
-                    quadrant_coords_icrs.cartesian.xyz.value, 0, -1)
-
-                for field_id, xyz in zip(
-                        tqdm(fields['field_id'], 'populating subfields'),
-                        quadrant_xyz):
-                    for ii, xyz in enumerate(xyz):
-                        ipix = hp.query_polygon(Localization.nside, xyz)
-                        db.session.merge(SubField(telescope=tele,
-                                                  field_id=int(field_id),
-                                                  subfield_id=int(ii),
-                                                  ipix=ipix.tolist()))
+
+def _invalidate_coverage(telescope, kind):
+    try:
+        os.remove(_coverage_cache_filename(telescope, kind))
+    except FileNotFoundError:
+        pass
+
+
+def _after_commit(session, func, *args):
+    """Call a function once after the session's current transaction commits,
+    or not at all if it is rolled back.
+
+    On-disk caches of database contents must be discarded after commit, not
+    at flush time. Otherwise, this or another process could rebuild them
+    from rows that are not committed yet or that are about to change.
+    """
+    session.info.setdefault('after_commit', {})[func, args] = None
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _run_after_commit(session):
+    for func, args in session.info.pop('after_commit', {}):
+        func(*args)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _discard_after_commit(session):
+    session.info.pop('after_commit', None)
+    session.info.pop('edited_plans', None)
 
 
 class User(db.Model, UserMixin):
@@ -516,6 +883,19 @@ class Field(db.Model):
 
     subfields = db.relationship(lambda: SubField)
 
+    @classmethod
+    def get_coverage(cls, telescope):
+        """Get the :class:`FieldTable` of all fields of a telescope, with rows
+        labeled by field ID."""
+        def build():
+            rows = db.session.query(
+                cls.field_id, cls.ra, cls.dec, cls.reference_filter_ids,
+                cls.ipix
+            ).filter_by(telescope=telescope).order_by(cls.field_id).all()
+            return FieldTable.from_fields(*(zip(*rows) if rows else [[]] * 5))
+
+        return _get_coverage(telescope, 'field_table', build, FieldTable)
+
 
 class SubField(db.Model):
     """SubFields"""
@@ -550,6 +930,25 @@ class SubField(db.Model):
         comment='Healpix indices')
 
 
+@db.event.listens_for(Field, 'after_insert')
+@db.event.listens_for(Field, 'after_delete')
+def _field_added_or_removed(mapper, connection, target):
+    """Discard the cached field table when a field is added or removed."""
+    _after_commit(db.inspect(target).session,
+                  _invalidate_coverage, target.telescope, 'field_table')
+
+
+@db.event.listens_for(Field, 'after_update')
+def _field_updated(mapper, connection, target):
+    """Discard the cached field table when a field moves or its footprint or
+    reference filters change."""
+    attrs = db.inspect(target).attrs
+    if any(getattr(attrs, key).history.has_changes()
+           for key in ['ra', 'dec', 'reference_filter_ids', 'ipix']):
+        _after_commit(db.inspect(target).session,
+                      _invalidate_coverage, target.telescope, 'field_table')
+
+
 class GcnNotice(db.Model):
     """Records of ingested GCN notices"""
 
@@ -646,25 +1045,25 @@ class Localization(db.Model):
         comment='Localization name')
 
     uniq = db.deferred(db.Column(
-        db.ARRAY(db.BigInteger),
+        NumpyArray('<i8'),
         nullable=False,
         comment='Multiresolution HEALPix UNIQ pixel index array'))
 
     probdensity = db.deferred(db.Column(
-        db.ARRAY(db.Float),
+        NumpyArray('<f8'),
         nullable=False,
         comment='Multiresolution HEALPix probability density array'))
 
     distmu = db.deferred(db.Column(
-        db.ARRAY(db.Float),
+        NumpyArray('<f8'),
         comment='Multiresolution HEALPix distance mu array'))
 
     distsigma = db.deferred(db.Column(
-        db.ARRAY(db.Float),
+        NumpyArray('<f8'),
         comment='Multiresolution HEALPix distance sigma array'))
 
     distnorm = db.deferred(db.Column(
-        db.ARRAY(db.Float),
+        NumpyArray('<f8'),
         comment='Multiresolution HEALPix distance normalization array'))
 
     contour = db.deferred(db.Column(
@@ -705,30 +1104,165 @@ class Localization(db.Model):
         else:
             return self.table_2d
 
+    def _cache_key(self):
+        """Unique file name component for this localization."""
+        return '{}_{}'.format(
+            self.dateobs.strftime('%Y%m%dT%H%M%S'),
+            urllib.parse.quote(self.localization_name, safe=''))
+
+    def _cache_filename(self, kind, suffix):
+        """Path of an on-disk cache file for this localization."""
+        return os.path.join(
+            app.instance_path, 'cache', kind,
+            '{}_{}'.format(self._cache_key(), suffix))
+
+    def _flat_cache_filename(self, column, nside=None, ordering='RING'):
+        """Path of the on-disk cache file for one rasterized column."""
+        if nside is None:
+            nside = Localization.nside
+        return self._cache_filename(
+            'flat', '{}_{}_{}.npy'.format(nside, ordering, column))
+
+    def _crossmatch_cache_filename(self, catalog):
+        """Path of the on-disk cache file for a galaxy catalog crossmatch."""
+        return self._cache_filename('crossmatch', '{}.npz'.format(catalog))
+
+    def _plot_cache_filename(self, plot, date):
+        """Path of the on-disk cache file for a rendered plot, such as
+        ``'observability'`` or ``'airmass_ZTF'``, for a given date."""
+        return os.path.join(
+            app.instance_path, 'cache', 'plots', self._cache_key(),
+            '{}_{}.png'.format(
+                urllib.parse.quote(plot, safe=''), date.isoformat()))
+
+    def _load_flat(self, columns):
+        """Load flat resolution arrays from the on-disk cache, raising
+        FileNotFoundError if any of them are missing."""
+        return tuple(
+            np.load(self._flat_cache_filename(column), mmap_mode='c')
+            for column in columns)
+
+    def _cached_flat(self, columns, func):
+        """Load flat resolution arrays from the on-disk cache, or compute them
+        by calling ``func`` and store them in the cache.
+
+        Cached arrays are memory-mapped copy-on-write, so callers may modify
+        them in place without affecting the cache.
+        """
+        filenames = [self._flat_cache_filename(column) for column in columns]
+        try:
+            return self._load_flat(columns)
+        except FileNotFoundError:
+            pass
+
+        result = tuple(func())
+        dirname = os.path.dirname(filenames[0])
+        os.makedirs(dirname, exist_ok=True)
+        for filename, data in zip(filenames, result):
+            # Write to a temporary file and rename it so that readers in other
+            # processes never see a partially written file.
+            with tempfile.NamedTemporaryFile(
+                    dir=dirname, suffix='.npy', delete=False) as f:
+                np.save(f, data)
+            os.replace(f.name, filename)
+        return result
+
+    def _cache_paths(self):
+        """Paths of all of the on-disk cache files and directories for this
+        localization."""
+        paths = [
+            self._flat_cache_filename(column) for column in
+            ['PROB', 'DISTMU', 'DISTSIGMA', 'DISTNORM', 'CREDIBLE_LEVEL']]
+        paths.append(self._crossmatch_cache_filename('CLU'))
+        paths.append(os.path.join(
+            app.instance_path, 'cache', 'plots', self._cache_key()))
+        return tuple(paths)
+
+    def invalidate_cache(self):
+        """Remove the cached flat resolution arrays, galaxy crossmatches, and
+        plots for this localization."""
+        _remove_paths(self._cache_paths())
+
     @property
     def flat_2d(self):
         """Get flat resolution HEALPix dataset, probability density only."""
-        order = hp.nside2order(Localization.nside)
-        result = rasterize(self.table_2d, order)['PROB']
-        return hp.reorder(result, 'NESTED', 'RING')
+        def func():
+            order = hp.nside2order(Localization.nside)
+            result = rasterize(self.table_2d, order)['PROB']
+            yield hp.reorder(result, 'NESTED', 'RING')
+
+        result, = self._cached_flat(['PROB'], func)
+        return result
 
     @property
     def credible_levels_2d(self):
-        return find_greedy_credible_levels(self.flat_2d)
+        def func():
+            yield find_greedy_credible_levels(self.flat_2d)
+
+        result, = self._cached_flat(['CREDIBLE_LEVEL'], func)
+        return result
 
     @property
     def flat(self):
         """Get flat resolution HEALPix dataset, probability density and
         distance."""
+        columns = ['PROB', 'DISTMU', 'DISTSIGMA', 'DISTNORM']
+
+        # If the cache is populated, then don't touch the (deferred)
+        # multiresolution columns at all.
+        try:
+            return self._load_flat(columns)
+        except FileNotFoundError:
+            pass
+
         if self.is_3d:
-            order = hp.nside2order(Localization.nside)
-            t = rasterize(self.table, order)
-            result = t['PROB'], t['DISTMU'], t['DISTSIGMA'], t['DISTNORM']
-            return hp.reorder(result, 'NESTED', 'RING')
+            def func():
+                order = hp.nside2order(Localization.nside)
+                t = rasterize(self.table, order)
+                for column in columns:
+                    yield hp.reorder(t[column], 'NESTED', 'RING')
+
+            return self._cached_flat(columns, func)
         else:
             return self.flat_2d,
 
 
+def _remove_paths(paths):
+    """Remove files and directories, ignoring any that do not exist."""
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+@db.event.listens_for(Localization, 'after_insert')
+@db.event.listens_for(Localization, 'after_delete')
+def _localization_replaced(mapper, connection, target):
+    """Discard cached data when a localization is created or deleted, in case
+    any are left over from an earlier row."""
+    _after_commit(db.inspect(target).session,
+                  _remove_paths, target._cache_paths())
+
+
+@db.event.listens_for(Localization, 'after_update')
+def _localization_updated(mapper, connection, target):
+    """Discard cached data when a localization's multiresolution data is
+    replaced."""
+    attrs = db.inspect(target).attrs
+    if any(attrs[key].history.has_changes() for key in
+           ['uniq', 'probdensity', 'distmu', 'distsigma', 'distnorm']):
+        _after_commit(db.inspect(target).session,
+                      _remove_paths, target._cache_paths())
+        crossmatch = CandidateCrossmatch.__table__
+        connection.execute(crossmatch.delete().where(
+            (crossmatch.c.dateobs == target.dateobs) &
+            (crossmatch.c.localization_name == target.localization_name)))
+
+
 class Plan(db.Model):
     """Tiling information, including the event time, localization ID, tile IDs,
     and plan name"""
@@ -781,33 +1315,108 @@ class Plan(db.Model):
         nullable=False,
         comment='Plan status')
 
+    timings = db.Column(
+        db.JSON,
+        comment='Wall time, CPU time, and peak memory of each stage of '
+        'plan generation')
+
+    summary = db.Column(
+        db.JSON,
+        comment='Summary statistics of the planned observations')
+
     planned_observations = db.relationship(
         'PlannedObservation', backref='plan',
         order_by=lambda: PlannedObservation.obstime)
 
+    @property
+    def planning_time(self):
+        """Total wall time spent generating the plan (seconds)."""
+        if self.timings is None:
+            return None
+        return sum(stage['wall'] for stage in self.timings
+                   if stage['depth'] == 0)
+
+    def _planned_observations_query(self):
+        return PlannedObservation.query.filter_by(
+            dateobs=self.dateobs, telescope=self.telescope,
+            plan_name=self.plan_name)
+
+    def _compute_summary(self):
+        """Calculate summary statistics of the planned observations."""
+        query = self._planned_observations_query()
+
+        first = query.order_by(PlannedObservation.obstime).first()
+        last = query.order_by(PlannedObservation.obstime.desc()).first()
+        if last is None:
+            end_observation = None
+        else:
+            end_observation = (Time(last.obstime) + (
+                last.exposure_time + last.overhead_per_exposure) * u.s
+            ).datetime.isoformat()
+
+        num_observations, total_time, total_overhead = query.with_entities(
+            db.func.count(),
+            db.func.coalesce(db.func.sum(PlannedObservation.exposure_time), 0),
+            db.func.coalesce(
+                db.func.sum(PlannedObservation.overhead_per_exposure), 0)
+        ).one()
+
+        bands = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
+        counts = dict(query.with_entities(
+            PlannedObservation.filter_id, db.func.count()
+        ).group_by(PlannedObservation.filter_id))
+        num_observations_per_filter = {
+            filt: 0 for filt in Telescope.query.get(self.telescope).filters}
+        for filter_id, count in counts.items():
+            num_observations_per_filter[bands[filter_id]] = count
+
+        return dict(
+            start_observation=(
+                None if first is None else first.obstime.isoformat()),
+            end_observation=end_observation,
+            num_observations=num_observations,
+            num_observations_per_filter=num_observations_per_filter,
+            total_time=total_time,
+            tot_time_with_overheads=total_time + total_overhead,
+            area=Field.get_coverage(self.telescope).area(self.field_ids))
+
+    def update_summary(self):
+        """Calculate and store summary statistics of the planned
+        observations, so that listing plans does not require loading
+        them."""
+        self.summary = self._compute_summary()
+
+    @property
+    def _summary(self):
+        """The stored summary statistics, or, for a plan that has none yet,
+        statistics that are calculated once per instance without storing
+        them."""
+        if self.summary is not None:
+            return self.summary
+        try:
+            return self._unstored_summary
+        except AttributeError:
+            self._unstored_summary = self._compute_summary()
+            return self._unstored_summary
+
     @property
     def start_observation(self):
         """Time of the first planned observation."""
-        if self.planned_observations:
-            return self.planned_observations[0].obstime
-        else:
-            return None
+        value = self._summary['start_observation']
+        return None if value is None else datetime.datetime.fromisoformat(
+            value)
 
     @property
     def end_observation(self):
         """Time of the end of planned observations."""
-        if self.planned_observations:
-            lastexp = self.planned_observations[-1]
-            end = Time(lastexp.obstime) + \
-                (lastexp.exposure_time + lastexp.overhead_per_exposure) * u.s
-            return end.datetime
-        else:
-            return None
+        value = self._summary['end_observation']
+        return None if value is None else datetime.datetime.fromisoformat(
+            value)
 
     @hybrid_property
     def num_observations(self):
         """Number of planned observation."""
-        return len(self.planned_observations)
+        return self._summary['num_observations']
 
     @num_observations.expression
     def num_observations(cls):
@@ -817,47 +1426,82 @@ class Plan(db.Model):
     @property
     def num_observations_per_filter(self):
         """Number of planned observation per filter."""
-        filters = list(Telescope.query.get(self.telescope).filters)
-        nepochs = np.zeros(len(filters),)
-        bands = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
-        for planned_observation in self.planned_observations:
-            filt = bands[planned_observation.filter_id]
-            idx = filters.index(filt)
-            nepochs[idx] = nepochs[idx] + 1
-        nobs_per_filter = []
-        for ii, filt in enumerate(filters):
-            nobs_per_filter.append("%s: %d" % (filt, nepochs[ii]))
-        return " ".join(nobs_per_filter)
+        return " ".join(
+            "%s: %d" % item
+            for item in self._summary['num_observations_per_filter'].items())
 
     @property
     def total_time(self):
         """Total observation time (seconds)."""
-        return sum(_.exposure_time for _ in self.planned_observations)
+        return self._summary['total_time']
 
     @property
     def tot_time_with_overheads(self):
-        overhead = sum(
-            _.overhead_per_exposure for _ in self.planned_observations)
-        return overhead + self.total_time
+        return self._summary['tot_time_with_overheads']
+
+    @property
+    def field_ids(self):
+        """IDs of the distinct fields in the plan."""
+        return [field_id for field_id, in db.session.query(
+            PlannedObservation.field_id
+        ).filter_by(
+            dateobs=self.dateobs, telescope=self.telescope,
+            plan_name=self.plan_name
+        ).distinct()]
 
     @property
     def ipix(self):
-        return {
-            i for planned_observation in self.planned_observations
-            if planned_observation.field.ipix is not None
-            for i in planned_observation.field.ipix}
+        """HEALPix pixels covered by the plan."""
+        return Field.get_coverage(self.telescope).ipix(self.field_ids)
 
     @property
     def area(self):
-        nside = Localization.nside
-        return hp.nside2pixarea(nside, degrees=True) * len(self.ipix)
+        return self._summary['area']
 
     def get_probability(self, localization):
-        ipix = np.asarray(list(self.ipix))
-        if len(ipix) > 0:
-            return localization.flat_2d[ipix].sum()
-        else:
-            return 0.0
+        return Field.get_coverage(self.telescope).probability(
+            self.field_ids, localization.flat_2d)
+
+    @staticmethod
+    def get_coverage_matrix(plans):
+        """Get the pixels covered by each of several plans.
+
+        Parameters
+        ----------
+        plans : list
+            The plans.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Boolean matrix with one row per plan and one column per HEALPix
+            pixel.
+        """
+        keys = [(plan.dateobs, plan.telescope, plan.plan_name)
+                for plan in plans]
+        field_ids = {key: [] for key in keys}
+        if keys:
+            for *key, field_id in db.session.query(
+                PlannedObservation.dateobs,
+                PlannedObservation.telescope,
+                PlannedObservation.plan_name,
+                PlannedObservation.field_id
+            ).filter(
+                db.tuple_(
+                    PlannedObservation.dateobs,
+                    PlannedObservation.telescope,
+                    PlannedObservation.plan_name
+                ).in_(keys)
+            ).distinct():
+                field_ids[tuple(key)].append(field_id)
+
+        result = sparse.csr_matrix(
+            (len(keys), hp.nside2npix(Localization.nside)), dtype=bool)
+        for telescope in {key[1] for key in keys}:
+            result = result + Field.get_coverage(telescope).unions([
+                field_ids[key] if key[1] == telescope else []
+                for key in keys])
+        return result
 
 
 class PlannedObservation(db.Model):
@@ -939,6 +1583,28 @@ class PlannedObservation(db.Model):
         comment='Overhead time per exposure in seconds')
 
 
+@db.event.listens_for(PlannedObservation, 'after_insert')
+@db.event.listens_for(PlannedObservation, 'after_update')
+@db.event.listens_for(PlannedObservation, 'after_delete')
+def _planned_observation_changed(mapper, connection, target):
+    """Record that a plan's planned observations were edited, so that its
+    summary statistics are calculated afresh before the edit is
+    committed."""
+    db.inspect(target).session.info.setdefault('edited_plans', set()).add(
+        (target.dateobs, target.telescope, target.plan_name))
+
+
+@db.event.listens_for(Session, 'before_commit')
+def _update_plan_summaries(session):
+    """Update the stored summary statistics of the plans whose planned
+    observations were edited, in the same transaction as the edits."""
+    session.flush()
+    for key in session.info.pop('edited_plans', ()):
+        plan = session.query(Plan).get(key)
+        if plan is not None:
+            plan.update_summary()
+
+
 class Observation(db.Model):
     """Observation information, including the field ID, exposure time, and
     filter."""
@@ -1009,6 +1675,59 @@ class Observation(db.Model):
         comment='processed successfully?')
 
 
+class IngestState(db.Model):
+    """Bookkeeping for incremental ingestion of observations from remote
+    archives: the timestamp of the latest observation ingested from each
+    source, and the cache validators of each remote file."""
+
+    source = db.Column(
+        db.String,
+        primary_key=True,
+        comment='Name of ingestion task, or URL of remote file')
+
+    watermark = db.Column(
+        db.DateTime,
+        comment='Timestamp of the latest observation ingested')
+
+    etag = db.Column(
+        db.String,
+        comment='ETag header of the last response')
+
+    last_modified = db.Column(
+        db.String,
+        comment='Last-Modified header of the last response')
+
+    @classmethod
+    def get(cls, source):
+        """Look up the state for a source, or create an empty one."""
+        return cls.query.get(source) or cls(source=source)
+
+    def get_start_time(self, lookback=1 * u.day, overlap=0 * u.s):
+        """Get the start time for an incremental ingest: the timestamp of
+        the latest observation that has already been ingested, or the
+        lookback time before now if nothing has been ingested yet.
+
+        Parameters
+        ----------
+        lookback : astropy.units.Quantity
+            How far back to start if nothing has been ingested yet.
+        overlap : astropy.units.Quantity
+            How far before the watermark to start, so that observations
+            that are recorded out of order are ingested on the next run.
+        """
+        if self.watermark is None:
+            return Time.now() - lookback
+        else:
+            return Time(self.watermark, scale='utc') - overlap
+
+    def advance(self, watermark):
+        """Move the watermark forward (but never backward) and add the
+        state to the session."""
+        if self.watermark is None or watermark > self.watermark:
+            self.watermark = watermark
+        db.session.add(self)
+
+
 class Candidate(db.Model):
 
     name = db.Column(
@@ -1202,3 +1921,93 @@ class CandidatePhotometry(db.Model):
         db.Integer,
         nullable=True,
         comment='Program ID number (1,2,3)')
+
+
+class CandidateCrossmatch(db.Model):
+    """Credible level and probability density of each candidate's position
+    in each localization."""
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ['dateobs',
+             'localization_name'],
+            ['localization.dateobs',
+             'localization.localization_name'],
+            ondelete='CASCADE',
+            onupdate='CASCADE'
+        ),
+    )
+
+    dateobs = db.Column(
+        db.DateTime,
+        primary_key=True,
+        comment='UTC event timestamp')
+
+    localization_name = db.Column(
+        db.String,
+        primary_key=True,
+        comment='Localization name')
+
+    name = db.Column(
+        db.ForeignKey(Candidate.name, ondelete='CASCADE'),
+        primary_key=True,
+        comment='Candidate name')
+
+    searched_prob = db.Column(
+        db.Float,
+        comment='Credible level at the position of the candidate')
+
+    probdensity = db.Column(
+        db.Float,
+        comment='Probability density at the position of the candidate')
+
+    @classmethod
+    def missing(cls, localization):
+        """Query the candidates that have not been crossmatched with a
+        localization yet."""
+        return Candidate.query.filter(~db.exists().where(
+            (cls.dateobs == localization.dateobs) &
+            (cls.localization_name == localization.localization_name) &
+            (cls.name == Candidate.name)))
+
+    @classmethod
+    def update(cls, localization, names=None):
+        """Crossmatch candidates with a localization and store the results.
+        Updating is idempotent, so concurrent updates are harmless.
+
+        Parameters
+        ----------
+        localization : Localization
+            The localization.
+        names : list, optional
+            Names of candidates to crossmatch, for example because they are
+            new or have moved. By default, crossmatch only the candidates
+            that have not been crossmatched with this localization yet.
+
+        Returns
+        -------
+        count : int
+            The number of candidates that were crossmatched.
+        """
+        if names is None:
+            query = cls.missing(localization)
+        else:
+            query = Candidate.query.filter(Candidate.name.in_(names))
+        rows = query.with_entities(
+            Candidate.name, Candidate.ra, Candidate.dec).all()
+        if not rows:
+            return 0
+
+        names, ra, dec = zip(*rows)
+        result = crossmatch(
+            localization.table,
+            coordinates.SkyCoord(np.asarray(ra) * u.deg,
+                                 np.asarray(dec) * u.deg))
+        return bulk_upsert(cls, (
+            dict(dateobs=localization.dateobs,
+                 localization_name=localization.localization_name,
+                 name=name,
+                 searched_prob=float(searched_prob),
+                 probdensity=float(probdensity))
+            for name, searched_prob, probdensity in zip(
+                names, result.searched_prob, result.probdensity)))
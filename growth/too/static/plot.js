@@ -0,0 +1,37 @@
+(function($) {
+
+    // Load a plot image that may still be rendering in the background.
+    // Until it is ready, the server responds with status 202 and a
+    // placeholder image, so keep polling until the plot itself arrives.
+    $.fn.plot = function(url, interval = 10000) {
+        let $img = this;
+        $img.data('plot-url', url);
+
+        function poll() {
+            fetch(url, {credentials: 'same-origin'}).then(function(response) {
+                // Give up if another plot has been requested since.
+                if ($img.data('plot-url') !== url) {
+                    return;
+                }
+                if (!response.ok) {
+                    $img.trigger('error');
+                    return;
+                }
+                if (response.status == 202) {
+                    setTimeout(poll, interval);
+                }
+                return response.blob().then(function(blob) {
+                    let old = $img.prop('src');
+                    $img.prop('src', URL.createObjectURL(blob));
+                    if (old && old.startsWith('blob:')) {
+                        URL.revokeObjectURL(old);
+                    }
+                });
+            });
+        }
+
+        poll();
+        return this;
+    };
+
+})(jQuery);
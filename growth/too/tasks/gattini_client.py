@@ -1,3 +1,5 @@
+from timeit import default_timer as timer
+
 from astropy import time
 import astropy.units as u
 from celery.task import PeriodicTask
@@ -13,7 +15,10 @@ __all__ = ('gattini_obs',)
 
 
 def get_obs(start_time, end_time):
-
+    """Get the start time and average limiting magnitude of every
+    observation (field and sequence number) with any stacks in a time
+    window. The aggregates include all stacks of each observation, even the
+    ones outside of the window."""
     engine = models.db.get_engine(app, 'GATTINI')
     result = engine.execute("""
                             SELECT ss.field, ss.fieldseq,
@@ -21,8 +26,14 @@ def get_obs(start_time, end_time):
                             avg(sp.limmagpsf) AS limmag
                             FROM splitstacks ss
                             INNER JOIN squadphoto sp ON
-                            sp.stackquadid = ss.stackquadid WHERE jd
-                            > %s AND jd < %s GROUP BY field, fieldseq
+                            sp.stackquadid = ss.stackquadid
+                            WHERE (ss.field, ss.fieldseq) IN (
+                                SELECT ss.field, ss.fieldseq
+                                FROM splitstacks ss
+                                INNER JOIN squadphoto sp ON
+                                sp.stackquadid = ss.stackquadid
+                                WHERE jd > %s AND jd < %s)
+                            GROUP BY ss.field, ss.fieldseq
                             ORDER BY utstart;
                             """, (start_time.jd, end_time.jd))
 
@@ -31,23 +42,47 @@ def get_obs(start_time, end_time):
 
 @celery.task(base=PeriodicTask, shared=False, run_every=3600)
 def gattini_obs(start_time=None, end_time=None):
+    """Ingest Gattini observations.
 
-    if start_time is None:
-        start_time = time.Time.now() - time.TimeDelta(1.0*u.day)
+    Parameters
+    ----------
+    start_time : astropy.Time
+        Start time of request. If omitted, then ingest only the observations
+        that are newer than an hour before the latest one that has already
+        been ingested (or from the past day, on the first run).
+    end_time : astropy.Time
+        End time of request. Defaults to now.
+
+    """
+    state = models.IngestState.get('gattini_obs')
+    incremental = start_time is None
+    if incremental:
+        # The watermark is the start of the latest observation, which may
+        # have gained more stacks since. Read it and its neighbors again.
+        start_time = state.get_start_time(overlap=1 * u.hour)
     if end_time is None:
         end_time = time.Time.now()
 
-    obstable = get_obs(start_time, end_time)
-
-    for row in obstable:
-        field_id, obsid, obstime, limmag = row
-        models.db.session.merge(
-            models.Observation(telescope='Gattini',
-                               field_id=int(field_id),
-                               observation_id=int(obsid),
-                               obstime=obstime,
-                               exposure_time=65,
-                               filter_id=5,
-                               limmag=limmag,
-                               successful=1))
+    obstable = list(get_obs(start_time, end_time))
+    if len(obstable) == 0:
+        log.info('No observations in time window to ingest.')
+        return
+
+    start = timer()
+    count = models.bulk_upsert(models.Observation, (
+        dict(telescope='Gattini',
+             field_id=int(field_id),
+             observation_id=int(obsid),
+             obstime=obstime,
+             exposure_time=65,
+             filter_id=5,
+             limmag=limmag,
+             subfield_id=0,
+             successful=True)
+        for field_id, obsid, obstime, limmag in obstable))
+    if incremental:
+        state.advance(max(obstime for _, _, obstime, _ in obstable))
     models.db.session.commit()
+    duration = timer() - start
+    log.info('Ingested %d observation rows in %.1f s (%.0f rows/s)',
+             count, duration, count / max(duration, 1e-9))
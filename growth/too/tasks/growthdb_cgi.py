@@ -5,10 +5,14 @@ from celery.utils.log import get_task_logger
 import requests
 
 from . import celery
+from .skymaps import crossmatch_candidates
 from .. import models
 
 log = get_task_logger(__name__)
 
+# Keep the candidate crossmatches of events this recent up to date.
+RECENT_EVENTS = timedelta(days=7)
+
 BASE_URL = 'http://skipper.caltech.edu:8080/cgi-bin/growth/'
 PROGRAM_NAMES = [
     # 'DECAM GW Followup',  # Duplicate record issues
@@ -75,9 +79,12 @@ def update_candidate_details(name, growth_marshal_id):
 def update_candidates():
     """Fetch the candidates present in the GROWTH marshal
     for the MMA science programs and store them in the local db."""
+    moved = []
     for s in get_candidates(get_program_ids()):
         # Find old row, if any
         old = models.Candidate.query.get(s['name'])
+        if old is None or (old.ra, old.dec) != (s['ra'], s['dec']):
+            moved.append(s['name'])
 
         # Create or update row
         last_updated = datetime.fromisoformat(s['last_updated'])
@@ -103,3 +110,15 @@ def update_candidates():
         dt = timedelta(seconds=60)
         if old is None or last_updated - old.last_updated > dt:
             update_candidate_details.delay(name, growth_marshal_id)
+
+    # Update the stored crossmatches of new or moved candidates with the
+    # localizations of recent events that have been crossmatched before.
+    # The rest are crossmatched when they are next viewed.
+    if moved:
+        crossmatch = models.CandidateCrossmatch
+        for dateobs, localization_name in models.db.session.query(
+                crossmatch.dateobs, crossmatch.localization_name
+        ).filter(
+            crossmatch.dateobs >= datetime.utcnow() - RECENT_EVENTS
+        ).distinct():
+            crossmatch_candidates.delay(localization_name, dateobs, moved)
@@ -1,3 +1,4 @@
+import datetime
 import json
 import os.path
 import requests
@@ -6,12 +7,14 @@ import subprocess
 import tempfile
 import urllib.parse
 import numpy as np
+import pandas as pd
 from astropy.table import Table
 from astropy.coordinates import SkyCoord, EarthLocation, get_moon
 from astropy.time import Time
 import astropy.units as u
 from astroplan import Observer, is_always_observable
 from astroplan.constraints import AltitudeConstraint
+from celery.task import PeriodicTask
 from celery.utils.log import get_task_logger
 from flask import flash
 
@@ -25,6 +28,14 @@ ZTF_URL = 'http://tunnel:9999'
 """URL for the P48 scheduler."""
 
 
+ZTF_QUEUE_CACHE_KEY = 'scheduler/ztf_queue'
+"""Cache key for the latest snapshot of the P48 scheduler's queues."""
+
+
+ZTF_QUEUE_TIMEOUT = 3600
+"""Maximum age in seconds of a snapshot of the P48 scheduler's queues."""
+
+
 GATTINI_PATH = 'mcoughlin@schoty.caltech.edu:gattini/too'
 """``scp`` path for Gattini schedules."""
 
@@ -103,6 +114,88 @@ def ping_ztf():
     return True
 
 
+def format_ztf_queue(data, queue):
+    """Describe the current queue of the P48 scheduler in plain text."""
+    queue_info = []
+    queue_info.append('Current queue information:')
+    queue_info.append(f"   Queue name: {data['queue_name']}")
+    queue_info.append(f"   Queue type: {data['queue_type']}")
+    queue_info.append(f"   Number of queued requests: {len(queue)}")
+    if len(queue) > 0:
+        n_fields = len(queue['field_id'].unique())
+        queue_info.append(f"   Number of unique field_ids: {n_fields}")
+        w = queue['ordered']
+        if np.sum(w) > 0:
+            queue_info.append("   Ordered requests:")
+            queue_info.append(queue.loc[w, ['field_id', 'ra', 'dec',
+                                            'filter_id', 'program_id',
+                                            'subprogram_name']].to_string())
+        queue_info.append("   Unordered requests:")
+        if 'slot_start_time' in queue.columns:
+            grp = queue[~w].groupby('slot_start_time')
+            for start_time, rows in grp:
+                queue_info.append(f"      {start_time}:")
+
+                rowstr = rows.to_csv(header=False,
+                                     columns=('field_id', 'ra', 'dec',
+                                              'filter_id', 'program_id',
+                                              'subprogram_name'))
+                queue_info = queue_info + rowstr.split("\n")
+        else:
+            queue_info.append(queue.loc[~w, ['field_id', 'ra', 'dec',
+                                             'filter_id', 'program_id',
+                                             'subprogram_name']].to_string())
+    return "\n".join(queue_info)
+
+
+@celery.task(base=PeriodicTask, ignore_result=True, shared=False,
+             run_every=300)
+def refresh_ztf_queue():
+    """Fetch the queues of the P48 scheduler and store a snapshot in the
+    cache, so that pages and observation planning need not wait for the
+    scheduler.
+
+    Returns
+    -------
+    dict
+        The snapshot, with the keys ``time`` (UTC time of the snapshot),
+        ``queue_names`` (names of all queues), ``queue_name`` and
+        ``queue_type`` (of the current queue), ``queue`` (the current queue
+        as a :class:`pandas.DataFrame`), and ``queue_info`` (a plain text
+        description of the current queue).
+    """
+    r = requests.get(urllib.parse.urljoin(ZTF_URL, 'queues'), json={})
+    r.raise_for_status()
+    queue_names = [data['queue_name'] for data in r.json()]
+
+    r = requests.get(urllib.parse.urljoin(ZTF_URL, 'current_queue'))
+    r.raise_for_status()
+    data = r.json()
+    queue = pd.read_json(data['queue'], orient='records')
+
+    snapshot = {
+        'time': datetime.datetime.utcnow(),
+        'queue_names': queue_names,
+        'queue_name': data['queue_name'],
+        'queue_type': data['queue_type'],
+        'queue': queue,
+        'queue_info': format_ztf_queue(data, queue)}
+    views.cache.set(ZTF_QUEUE_CACHE_KEY, snapshot, timeout=ZTF_QUEUE_TIMEOUT)
+    return snapshot
+
+
+def get_ztf_queue():
+    """Get the latest snapshot of the queues of the P48 scheduler, fetching
+    a new one if there is none.
+
+    See :func:`refresh_ztf_queue` for the contents of the snapshot.
+    """
+    snapshot = views.cache.get(ZTF_QUEUE_CACHE_KEY)
+    if snapshot is None:
+        snapshot = refresh_ztf_queue()
+    return snapshot
+
+
 @celery.task(shared=False)
 def ping_gattini():
     """Check connectivity with Gattini scheduler."""
@@ -171,6 +264,7 @@ def schedule_ztf(json_data):
         flash(r.text, 'danger')
     else:
         flash(r.text, 'success')
+        refresh_ztf_queue()
 
 
 @celery.task(ignore_result=True, shared=False)
@@ -1,4 +1,6 @@
+import datetime
 import os
+import tempfile
 from urllib.error import URLError
 from urllib.parse import urlparse
 
@@ -8,12 +10,17 @@ from astropy_healpix import HEALPix, nside_to_level, pixel_resolution_to_nside
 from ligo.skymap import io
 from ligo.skymap import moc
 from ligo.skymap import postprocess
+from ligo.skymap.tool.ligo_skymap_plot_airmass import main as plot_airmass
+from ligo.skymap.tool.ligo_skymap_plot_observability import main \
+    as plot_observability
+import matplotlib.style
 import numpy as np
 
 from . import celery
-from .. import models
+from .. import catalogs, models, views
 
-__all__ = ('download', 'from_cone', 'contour')
+__all__ = ('download', 'from_cone', 'warm_flat_cache', 'contour',
+           'crossmatch_galaxies', 'crossmatch_candidates', 'render_plots')
 
 
 @celery.task(autoretry_for=(URLError,), max_retries=20, shared=False)
@@ -25,11 +32,11 @@ def download(url, dateobs):
         except KeyError:
             return None
         else:
-            return col.tolist()
+            return np.asarray(col)
 
     filename = os.path.basename(urlparse(url).path)
     skymap = io.read_sky_map(url, moc=True)
-    models.db.session.merge(
+    localization = models.db.session.merge(
         models.Localization(
             localization_name=filename,
             dateobs=dateobs,
@@ -39,9 +46,30 @@ def download(url, dateobs):
             distsigma=get_col(skymap, 'DISTSIGMA'),
             distnorm=get_col(skymap, 'DISTNORM')))
     models.db.session.commit()
+    _warm_flat_cache(localization)
     return filename
 
 
+def _warm_flat_cache(localization):
+    """Rasterize a new localization into the on-disk flat resolution cache.
+
+    The per-telescope tiling tasks that follow a new localization all start
+    at once. Rasterizing here first means that they share one memory-mapped
+    copy of the flat resolution map, rather than each of them loading the
+    multiresolution data from the database and rasterizing it again.
+    """
+    localization.flat
+
+
+@celery.task(shared=False)
+def warm_flat_cache(localization_name, dateobs):
+    """Rasterize a localization into the on-disk flat resolution cache before
+    the tasks that it is chained to start, and pass on its name."""
+    _warm_flat_cache(models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one())
+    return localization_name
+
+
 @celery.task(shared=False)
 def from_cone(ra, dec, error, dateobs):
     localization_name = "%.5f_%.5f_%.5f" % (ra, dec, error)
@@ -69,13 +97,14 @@ def from_cone(ra, dec, error, dateobs):
         u.dimensionless_unscaled))
     probdensity /= probdensity.sum() * hpx.pixel_area.to_value(u.steradian)
 
-    models.db.session.merge(
+    localization = models.db.session.merge(
         models.Localization(
             localization_name=localization_name,
             dateobs=dateobs,
-            uniq=uniq.tolist(),
-            probdensity=probdensity.tolist()))
+            uniq=uniq,
+            probdensity=probdensity))
     models.db.session.commit()
+    _warm_flat_cache(localization)
 
     return localization_name
 
@@ -122,3 +151,90 @@ def contour(localization_name, dateobs):
     }
     models.db.session.merge(localization)
     models.db.session.commit()
+    views.invalidate_cache(dateobs, localization_name=localization_name)
+
+
+@celery.task(ignore_result=True, shared=False)
+def crossmatch_galaxies(localization_name, dateobs):
+    """Crossmatch a new localization with the galaxy catalog ahead of time,
+    so that the galaxies page can just filter, sort, and page through the
+    cached results."""
+    localization = models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one()
+    catalogs.get_crossmatch(localization)
+
+
+@celery.task(ignore_result=True, shared=False)
+def crossmatch_candidates(localization_name, dateobs, names=None):
+    """Update the stored crossmatch of candidates with a localization, either
+    for the named candidates or for any that have not been crossmatched
+    yet."""
+    localization = models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one()
+    models.CandidateCrossmatch.update(localization, names)
+    models.db.session.commit()
+
+
+def _render(plot, args, filename):
+    """Run a ligo-skymap-plot-* command, writing the plot to a temporary
+    file and renaming it so that readers never see a partial file."""
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=dirname, suffix='.png', delete=False) as f:
+        pass
+    try:
+        with matplotlib.style.context('default'):
+            plot([*args, '-o', f.name])
+        os.replace(f.name, filename)
+    except Exception:
+        os.remove(f.name)
+        raise
+
+
+@celery.task(ignore_result=True, shared=False)
+def render_plots(localization_name, dateobs, dates=None):
+    """Render the observability plot and the airmass plot for each telescope
+    ahead of time, so that pages can show them without waiting.
+
+    Parameters
+    ----------
+    localization_name : str
+        The localization name.
+    dateobs : datetime.datetime
+        The event time.
+    dates : list, optional
+        The dates to render the plots for. The default is today and
+        tomorrow.
+    """
+    localization = models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one()
+    if dates is None:
+        today = datetime.date.today()
+        dates = [today, today + datetime.timedelta(days=1)]
+    telescopes = models.Telescope.query.all()
+    names, lons, lats, heights = zip(*(
+        (t.telescope, str(t.lon), str(t.lat), str(t.elevation))
+        for t in telescopes))
+
+    with tempfile.NamedTemporaryFile(suffix='.fits') as fitsfile:
+        io.write_sky_map(fitsfile.name, localization.table_2d, moc=True)
+        for date in dates:
+            _render(plot_observability,
+                    ['--site-name', *names,
+                     '--site-longitude', *lons,
+                     '--site-latitude', *lats,
+                     '--site-height', *heights,
+                     '--time', date.isoformat(),
+                     fitsfile.name],
+                    localization._plot_cache_filename('observability', date))
+            for telescope in telescopes:
+                _render(plot_airmass,
+                        ['--site-longitude', str(telescope.lon),
+                         '--site-latitude', str(telescope.lat),
+                         '--site-height', str(telescope.elevation),
+                         '--site-timezone', telescope.timezone,
+                         '--time', date.isoformat(),
+                         fitsfile.name],
+                        localization._plot_cache_filename(
+                            'airmass_' + telescope.telescope, date))
@@ -1,8 +1,11 @@
+import contextlib
+import cProfile
 import datetime
 import os
-import glob
 import copy
-import requests
+import resource
+import tempfile
+from timeit import default_timer
 import urllib.parse
 
 from astropy import table
@@ -23,12 +26,12 @@ import gwemopt.tiles
 import gwemopt.segments
 import gwemopt.catalog
 from ligo import segments
+from ligo.skymap.postprocess import find_greedy_credible_levels
 import numpy as np
-import pandas as pd
 
 import growth
 from . import celery
-from .. import models
+from .. import catalogs, models, views
 from ..flask import app
 
 log = get_task_logger(__name__)
@@ -36,6 +39,167 @@ log = get_task_logger(__name__)
 __all__ = ('tile',)
 
 
+def _get_config_directory():
+    growthpath = os.path.dirname(growth.__file__)
+    return os.path.join(growthpath, 'too', 'config')
+
+
+def _get_config_filename(telescope):
+    return os.path.join(_get_config_directory(), telescope + '.config')
+
+
+_telescope_configs = {}
+
+
+def _get_mtimes(filenames):
+    return tuple(os.stat(filename).st_mtime_ns for filename in filenames)
+
+
+def _load_telescope_config(telescope):
+    """Load the gwemopt configuration for a telescope, including its
+    tessellation and reference images.
+
+    The result is cached per process, and is read again if the configuration
+    file, tessellation file, or reference file has been modified since. It
+    is shared by all callers, so it must not be modified. Use
+    :func:`get_telescope_config` to get a private copy.
+    """
+    try:
+        filenames, mtimes, config = _telescope_configs[telescope]
+    except KeyError:
+        pass
+    else:
+        if _get_mtimes(filenames) == mtimes:
+            return config
+
+    config = _read_telescope_config(telescope)
+    filenames = [_get_config_filename(telescope)] + [
+        config[key] for key in ['tesselationFile', 'referenceFile']
+        if key in config]
+    _telescope_configs[telescope] = filenames, _get_mtimes(filenames), config
+    return config
+
+
+def _read_telescope_config(telescope):
+    config_directory = _get_config_directory()
+    config = gwemopt.utils.readParamsFromFile(
+        _get_config_filename(telescope))
+    config["telescope"] = telescope
+    if "tesselationFile" in config:
+        config["tesselationFile"] =\
+            os.path.join(config_directory, config["tesselationFile"])
+        tesselation_file = config["tesselationFile"]
+        if not os.path.isfile(tesselation_file):
+            if config["FOV_type"] == "circle":
+                gwemopt.tiles.tesselation_spiral(config)
+            elif config["FOV_type"] == "square":
+                gwemopt.tiles.tesselation_packing(config)
+
+        config["tesselation"] =\
+            np.loadtxt(config["tesselationFile"],
+                       usecols=(0, 1, 2), comments='%')
+        config["tesselation"].setflags(write=False)
+
+    if "referenceFile" in config:
+        config["referenceFile"] =\
+            os.path.join(config_directory, config["referenceFile"])
+        refs = table.unique(table.Table.read(
+            config["referenceFile"],
+            format='ascii', data_start=2, data_end=-1)['field', 'fid'])
+        reference_images =\
+            {group[0]['field']: group['fid'].astype(int).tolist()
+             for group in refs.group_by('field').groups}
+        reference_images_map = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
+        for key in reference_images:
+            reference_images[key] = [reference_images_map.get(n, n)
+                                     for n in reference_images[key]]
+        config["reference_images"] = reference_images
+
+    return config
+
+
+def get_telescope_config(telescope):
+    """Get a private copy of the gwemopt configuration for a telescope.
+
+    The configuration files are read again only when they change. gwemopt
+    replaces, but does not modify, the values in the configuration, so a
+    shallow copy suffices. The tessellation array is read-only.
+    """
+    config = dict(_load_telescope_config(telescope))
+
+    # The observer is stateful, so always create a new one.
+    observer = ephem.Observer()
+    observer.lat = str(config["latitude"])
+    observer.lon = str(config["longitude"])
+    observer.horizon = str(-12.0)
+    observer.elevation = config["elevation"]
+    config["observer"] = observer
+
+    return config
+
+
+class StageTimer:
+    """Record the wall time, CPU time, and change in resident memory of each
+    stage of plan generation.
+
+    Use an instance as a context manager factory, one call per stage. Stages
+    may be nested.
+
+    Parameters
+    ----------
+    profile : bool
+        If True, then also run cProfile while inside any stage.
+    """
+
+    def __init__(self, profile=False):
+        self.stages = []
+        self.depth = 0
+        self.profiler = cProfile.Profile() if profile else None
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        stage = dict(stage=name, depth=self.depth)
+        self.stages.append(stage)
+        if self.profiler is not None and self.depth == 0:
+            self.profiler.enable()
+        self.depth += 1
+        wall = default_timer()
+        cpu = self._cpu_time()
+        rss = self._rss()
+        try:
+            yield
+        finally:
+            stage['wall'] = default_timer() - wall
+            stage['cpu'] = self._cpu_time() - cpu
+            end_rss = self._rss()
+            stage['rss'] = (
+                None if rss is None or end_rss is None else end_rss - rss)
+            self.depth -= 1
+            if self.profiler is not None and self.depth == 0:
+                self.profiler.disable()
+
+    @staticmethod
+    def _cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    @staticmethod
+    def _rss():
+        """Get the current resident memory of the process in MB, or None if it
+        is not available on this platform."""
+        try:
+            with open('/proc/self/statm') as f:
+                pages = int(f.read().split()[1])
+        except OSError:
+            return None
+        return pages * resource.getpagesize() / 2**20
+
+    def dump_stats(self, filename):
+        """Write the cProfile statistics to a file."""
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.profiler.dump_stats(filename)
+
+
 def params_struct(dateobs, tobs=None, filt=['r'], exposuretimes=[60.0],
                   mindiff=30.0*60.0, probability=0.9, tele='ZTF',
                   airmass=2.5,
@@ -51,66 +215,24 @@ def params_struct(dateobs, tobs=None, filt=['r'], exposuretimes=[60.0],
                   doMaxTiles=False,
                   max_nb_tiles=1000,
                   doRASlice=False,
-                  raslice=[0, 24]):
+                  raslice=[0, 24],
+                  timer=None):
+
+    if timer is None:
+        timer = StageTimer()
 
     growthpath = os.path.dirname(growth.__file__)
-    config_directory = os.path.join(growthpath, 'too', 'config')
     tiling_directory = os.path.join(growthpath, 'too', 'tiling')
 
     catalogpath = os.path.join('too', 'catalog')
     try:
-        app.open_instance_resource('%s/CLU.hdf5' % catalogpath)
+        app.open_instance_resource('%s/CLU.hdf5' % catalogpath).close()
         catalog_directory = app.instance_path
     except IOError:
         catalog_directory = os.path.join(growthpath, catalogpath)
 
     params = {}
-    params["config"] = {}
-    config_files = glob.glob("%s/*.config" % config_directory)
-    for config_file in config_files:
-        telescope = config_file.split("/")[-1].replace(".config", "")
-        params["config"][telescope] =\
-            gwemopt.utils.readParamsFromFile(config_file)
-        params["config"][telescope]["telescope"] = telescope
-        if "tesselationFile" in params["config"][telescope]:
-            params["config"][telescope]["tesselationFile"] =\
-                os.path.join(config_directory,
-                             params["config"][telescope]["tesselationFile"])
-            tesselation_file = params["config"][telescope]["tesselationFile"]
-            if not os.path.isfile(tesselation_file):
-                if params["config"][telescope]["FOV_type"] == "circle":
-                    gwemopt.tiles.tesselation_spiral(
-                        params["config"][telescope])
-                elif params["config"][telescope]["FOV_type"] == "square":
-                    gwemopt.tiles.tesselation_packing(
-                        params["config"][telescope])
-
-            params["config"][telescope]["tesselation"] =\
-                np.loadtxt(params["config"][telescope]["tesselationFile"],
-                           usecols=(0, 1, 2), comments='%')
-
-        if "referenceFile" in params["config"][telescope]:
-            params["config"][telescope]["referenceFile"] =\
-                os.path.join(config_directory,
-                             params["config"][telescope]["referenceFile"])
-            refs = table.unique(table.Table.read(
-                params["config"][telescope]["referenceFile"],
-                format='ascii', data_start=2, data_end=-1)['field', 'fid'])
-            reference_images =\
-                {group[0]['field']: group['fid'].astype(int).tolist()
-                 for group in refs.group_by('field').groups}
-            reference_images_map = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
-            for key in reference_images:
-                reference_images[key] = [reference_images_map.get(n, n)
-                                         for n in reference_images[key]]
-            params["config"][telescope]["reference_images"] = reference_images
-
-        observer = ephem.Observer()
-        observer.lat = str(params["config"][telescope]["latitude"])
-        observer.lon = str(params["config"][telescope]["longitude"])
-        observer.horizon = str(-12.0)
-        observer.elevation = params["config"][telescope]["elevation"]
-        params["config"][telescope]["observer"] = observer
+    params["config"] = {tele: get_telescope_config(tele)}
 
     params["skymap"] = ""
     params["gpstime"] = -1
@@ -215,7 +337,8 @@ def params_struct(dateobs, tobs=None, filt=['r'], exposuretimes=[60.0],
     params["doRASlice"] = doRASlice
     params["raslice"] = raslice
 
-    params = gwemopt.segments.get_telescope_segments(params)
+    with timer('get_telescope_segments'):
+        params = gwemopt.segments.get_telescope_segments(params)
     params = gwemopt.utils.params_checker(params)
 
     if doCompletedObservations or doPlannedObservations:
@@ -234,72 +357,64 @@ def params_struct(dateobs, tobs=None, filt=['r'], exposuretimes=[60.0],
             completed_start_time = time.Time(cobs[0], format='mjd')
             completed_end_time = time.Time(cobs[1], format='mjd')
 
-        observations = models.Observation.query.filter(
-            (models.Observation.telescope == tele) &
-            (models.Observation.obstime >= completed_start_time.datetime) &
-            (models.Observation.obstime <= completed_end_time.datetime)).all()
-
-        for observation in observations:
-            field_id = observation.field_id
-            ipix = observation.field.ipix
-            ra, dec = observation.field.ra, observation.field.dec
-            filter_id = observation.filter_id
-            exposure_time = observation.exposure_time
-            successful = observation.successful
-
-            mjd_exposure_start = time.Time(observation.obstime).mjd
-
-            if successful:
-                coverage_struct["data"] = np.append(
-                    coverage_struct["data"],
-                    np.array([[ra, dec, mjd_exposure_start, -1,
-                               exposure_time, field_id, -1, -1]]), axis=0)
-                coverage_struct["filters"].append(bands[filter_id])
-                coverage_struct["ipix"].append(ipix)
-
-        if len(coverage_struct["data"]) > 0:
-            rows, idx, cnts = np.unique(coverage_struct["data"],
-                                        return_index=True,
-                                        return_counts=True,
-                                        axis=0)
-            if tele == "ZTF":
-                idx = idx[cnts >= 32]
-            coverage_struct["data"] = coverage_struct["data"][idx, :]
-            coverage_struct["filters"] = [coverage_struct["filters"][ii]
-                                          for ii in idx]
-            coverage_struct["ipix"] = [coverage_struct["ipix"][ii]
-                                       for ii in idx]
-            params["previous_coverage_struct"] = coverage_struct
+        # Find exposures with their number of successful quadrants/chips.
+        Observation = models.Observation
+        Field = models.Field
+        columns = (Field.ra, Field.dec, Observation.obstime,
+                   Observation.exposure_time, Observation.field_id,
+                   Observation.filter_id)
+        query = models.db.session.query(*columns).join(
+            Observation.field
+        ).filter(
+            (Observation.telescope == tele) &
+            (Observation.obstime >= completed_start_time.datetime) &
+            (Observation.obstime <= completed_end_time.datetime) &
+            Observation.successful
+        ).group_by(*columns).order_by(*columns)
+        if tele == "ZTF":
+            # Only count exposures with at least half of the quadrants.
+            query = query.having(models.db.func.count() >= 32)
+        exposures = query.all()
+
+        if exposures:
+            ra, dec, obstime, exposure_time, field_id, filter_id = \
+                zip(*exposures)
+            nexposures = len(exposures)
+            completed_coverage_struct = {
+                "data": np.column_stack((
+                    ra, dec, time.Time(list(obstime)).mjd,
+                    np.full(nexposures, -1), exposure_time, field_id,
+                    np.full(nexposures, -1), np.full(nexposures, -1)
+                )).astype(float),
+                "filters": [bands[_] for _ in filter_id],
+                "ipix": models.Field.get_coverage(tele).ipix_rows(field_id)
+            }
+            params["previous_coverage_struct"] = completed_coverage_struct
 
     if doPlannedObservations:
 
-        from .scheduler import ZTF_URL
+        from .scheduler import get_ztf_queue
 
-        r = requests.get(
-            urllib.parse.urljoin(ZTF_URL, 'current_queue'))
-        data = r.json()
-        queue = pd.read_json(data['queue'], orient='records')
+        queue = get_ztf_queue()['queue']
         if len(queue) > 0:
-            for index, row in queue.iterrows():
-                field_id = row["field_id"]
-                filter_id = row["filter_id"]
-                exposure_time = row["exposure_time"]
-                start_time = time.Time(row["slot_start_time"],
+            # Look up all of the fields at once, skipping unknown fields.
+            queue = queue[queue["program_id"] != 1]
+            fields = models.Field.get_coverage(tele)
+            rows = fields.find(queue["field_id"])
+            queue, rows = queue[rows >= 0], rows[rows >= 0]
+            nexposures = len(queue)
+            if nexposures:
+                start_time = time.Time(list(queue["slot_start_time"]),
                                        format="datetime")
-                program_id = row["program_id"]
-                if program_id == 1:
-                    continue
-
-                if np.isnan(filter_id):
-                    filter_id = 2
-                f = models.Field.query.filter_by(telescope=tele,
-                                                 field_id=field_id).one()
-                coverage_struct["data"] = np.append(
-                    coverage_struct["data"],
-                    np.array([[f.ra, f.dec, start_time.mjd, -1,
-                               exposure_time, field_id, -1, -1]]), axis=0)
-                coverage_struct["filters"].append(bands[filter_id])
-                coverage_struct["ipix"].append(f.ipix)
+                coverage_struct["data"] = np.column_stack((
+                    fields.ra[rows], fields.dec[rows], start_time.mjd,
+                    np.full(nexposures, -1), queue["exposure_time"],
+                    queue["field_id"], np.full(nexposures, -1),
+                    np.full(nexposures, -1)
+                )).astype(float)
+                coverage_struct["filters"] = [
+                    bands[_] for _ in queue["filter_id"].fillna(2).astype(int)]
+                coverage_struct["ipix"] = fields.ipix_rows(queue["field_id"])
 
             if "previous_coverage_struct" in params:
                 params["previous_coverage_struct"] = \
@@ -315,47 +430,83 @@ def params_struct(dateobs, tobs=None, filt=['r'], exposuretimes=[60.0],
     return params
 
 
-def gen_structs(params):
+def select_galaxies(params, directory):
+    """Restrict galaxy-targeted planning to the galaxies in the credible
+    region of the sky map.
+
+    gwemopt grades every galaxy in the catalog, but only the galaxies within
+    the ``powerlaw_cl`` credible region get nonzero grades. Write just those
+    galaxies to a catalog in ``directory`` and point gwemopt to it. If there
+    are no galaxies in the region, then leave the full catalog in place,
+    because gwemopt falls back to grading all galaxies equally.
+    """
+    prob = params['map_struct']['prob']
+    prob = prob / prob.sum()
+    # Include every pixel that gwemopt could count as inside the region.
+    region = find_greedy_credible_levels(prob) - prob <= params['powerlaw_cl']
+    rows = catalogs.galaxies_in_region(region)
+    if len(rows) > 0:
+        catalogs.write_galaxies(os.path.join(
+            directory, '{}.hdf5'.format(params['galaxy_catalog'])), rows)
+        params['catalogDir'] = directory
+
+
+def gen_structs(params, timer=None):
+
+    if timer is None:
+        timer = StageTimer()
 
     log.info('Loading skymap')
     # Function to read maps
-    map_struct = gwemopt.utils.read_skymap(params, is3D=params["do3D"],
-                                           map_struct=params['map_struct'])
+    with timer('read_skymap'):
+        map_struct = gwemopt.utils.read_skymap(
+            params, is3D=params["do3D"], map_struct=params['map_struct'])
 
     if params["tilesType"] == "galaxy":
         log.info("Generating catalog...")
-        map_struct, catalog_struct =\
-            gwemopt.catalog.get_catalog(params, map_struct)
+        with timer('catalog.get_catalog'):
+            map_struct, catalog_struct =\
+                gwemopt.catalog.get_catalog(params, map_struct)
 
     if params["tilesType"] == "moc":
         log.info('Generating MOC struct')
-        moc_structs = gwemopt.moc.create_moc(params, map_struct=map_struct)
-        tile_structs = gwemopt.tiles.moc(params, map_struct, moc_structs)
+        with timer('moc.create_moc'):
+            moc_structs = gwemopt.moc.create_moc(
+                params, map_struct=map_struct)
+        with timer('tiles.moc'):
+            tile_structs = gwemopt.tiles.moc(params, map_struct, moc_structs)
     elif params["tilesType"] == "ranked":
         log.info('Generating ranked struct')
-        moc_structs = gwemopt.rankedTilesGenerator.create_ranked(params,
-                                                                 map_struct)
-        tile_structs = gwemopt.tiles.moc(params, map_struct, moc_structs)
+        with timer('rankedTilesGenerator.create_ranked'):
+            moc_structs = gwemopt.rankedTilesGenerator.create_ranked(
+                params, map_struct)
+        with timer('tiles.moc'):
+            tile_structs = gwemopt.tiles.moc(params, map_struct, moc_structs)
     elif params["tilesType"] == "hierarchical":
         log.info('Generating hierarchical struct')
-        tile_structs = gwemopt.tiles.hierarchical(params, map_struct)
+        with timer('tiles.hierarchical'):
+            tile_structs = gwemopt.tiles.hierarchical(params, map_struct)
     elif params["tilesType"] == "greedy":
         log.info('Generating greedy struct')
-        tile_structs = gwemopt.tiles.greedy(params, map_struct)
+        with timer('tiles.greedy'):
+            tile_structs = gwemopt.tiles.greedy(params, map_struct)
     elif params["tilesType"] == "galaxy":
         log.info("Generating galaxy struct...")
-        tile_structs = gwemopt.tiles.galaxy(params, map_struct, catalog_struct)
+        with timer('tiles.galaxy'):
+            tile_structs = gwemopt.tiles.galaxy(
+                params, map_struct, catalog_struct)
     else:
         raise ValueError(
             'Need tilesType to be moc, greedy, hierarchical, galaxy or ranked')
 
-    if "previous_coverage_struct" in params:
-        tile_structs, coverage_struct = gwemopt.coverage.timeallocation(
-            params, map_struct, tile_structs,
-            previous_coverage_struct=params["previous_coverage_struct"])
-    else:
-        tile_structs, coverage_struct = gwemopt.coverage.timeallocation(
-            params, map_struct, tile_structs)
+    with timer('coverage.timeallocation'):
+        if "previous_coverage_struct" in params:
+            tile_structs, coverage_struct = gwemopt.coverage.timeallocation(
+                params, map_struct, tile_structs,
+                previous_coverage_struct=params["previous_coverage_struct"])
+        else:
+            tile_structs, coverage_struct = gwemopt.coverage.timeallocation(
+                params, map_struct, tile_structs)
 
     if params["doPlots"]:
         gwemopt.plotting.skymap(params, map_struct)
@@ -367,6 +518,14 @@ def gen_structs(params):
 
 def get_planned_observations(
         params, map_struct, tile_structs, coverage_struct):
+    """Convert a gwemopt coverage struct to planned observations.
+
+    Returns
+    -------
+    list
+        Dictionaries of column values for :class:`PlannedObservation` rows,
+        excluding the event time and plan name.
+    """
 
     nside = map_struct["nside"]
 
@@ -433,29 +592,32 @@ def get_planned_observations(
                     models.db.session.merge(field)
 
         filter_ids = {"g": 1, "r": 2, "i": 3, "z": 4, "J": 5}
-        for ii in range(len(coverage_struct["ipix"])):
-            data = coverage_struct["data"][ii, :]
-            filt = coverage_struct["filters"][ii]
-            filter_id = filter_ids[filt]
-            mjd = data[2]
-            tt = time.Time(mjd, format='mjd')
-
-            if config_struct["overhead_per_exposure"] is not None:
-                overhead_per_exposure = config_struct["overhead_per_exposure"]
-            else:
-                overhead_per_exposure = 0.0
-
-            exposure_time, field_id, prob = data[4], data[5], data[6]
-
-            yield models.PlannedObservation(
-                obstime=tt.datetime,
-                field_id=field_id,
-                exposure_time=exposure_time,
-                weight=prob,
-                filter_id=filter_id,
-                telescope=telescope,
-                planned_observation_id=ii,
-                overhead_per_exposure=overhead_per_exposure)
+        if config_struct["overhead_per_exposure"] is not None:
+            overhead_per_exposure = config_struct["overhead_per_exposure"]
+        else:
+            overhead_per_exposure = 0.0
+        overhead_per_exposure = int(round(overhead_per_exposure))
+
+        data = coverage_struct["data"]
+        obstimes = time.Time(data[:, 2], format='mjd').datetime
+        exposure_times = np.rint(data[:, 4]).astype(int).tolist()
+        planned_field_ids = np.rint(data[:, 5]).astype(int).tolist()
+        probs = data[:, 6].tolist()
+
+        return [
+            dict(planned_observation_id=ii,
+                 obstime=obstime,
+                 field_id=field_id,
+                 exposure_time=exposure_time,
+                 weight=prob,
+                 filter_id=filter_ids[filt],
+                 telescope=telescope,
+                 overhead_per_exposure=overhead_per_exposure)
+            for ii, (obstime, field_id, exposure_time, prob, filt)
+            in enumerate(zip(obstimes, planned_field_ids, exposure_times,
+                             probs, coverage_struct["filters"]))]
+    else:
+        return []
 
 
 @celery.task(ignore_result=True, shared=False)
@@ -503,33 +665,39 @@ def tile(localization_name, dateobs, telescope,
     models.db.session.merge(plan)
     models.db.session.commit()
 
+    timer = StageTimer(profile=app.config['PROFILE_PLANS'])
+
     planned = plan_args['doPlannedObservations']
     completed = plan_args['doCompletedObservations']
     maxtiles = plan_args['doMaxTiles']
 
-    params = params_struct(dateobs, tobs=np.asarray(plan_args['tobs']),
-                           filt=plan_args['filt'],
-                           exposuretimes=exposuretimes,
-                           probability=plan_args['probability'],
-                           tele=telescope,
-                           schedule_type=plan_args['schedule_type'],
-                           doReferences=plan_args['doReferences'],
-                           doUsePrimary=plan_args['doUsePrimary'],
-                           filterScheduleType=plan_args['filterScheduleType'],
-                           schedule_strategy=plan_args['schedule_strategy'],
-                           mindiff=plan_args['mindiff'],
-                           doCompletedObservations=completed,
-                           cobs=plan_args['cobs'],
-                           doPlannedObservations=planned,
-                           doMaxTiles=maxtiles,
-                           max_nb_tiles=plan_args['max_nb_tiles'],
-                           doRASlice=plan_args['doRASlice'],
-                           raslice=plan_args['raslice'],
-                           doBalanceExposure=plan_args['doBalanceExposure'],
-                           airmass=plan_args['airmass'])
-
-    params['map_struct'] = dict(
-        zip(['prob', 'distmu', 'distsigma', 'distnorm'], localization.flat))
+    with timer('params_struct'):
+        params = params_struct(
+            dateobs, tobs=np.asarray(plan_args['tobs']),
+            filt=plan_args['filt'],
+            exposuretimes=exposuretimes,
+            probability=plan_args['probability'],
+            tele=telescope,
+            schedule_type=plan_args['schedule_type'],
+            doReferences=plan_args['doReferences'],
+            doUsePrimary=plan_args['doUsePrimary'],
+            filterScheduleType=plan_args['filterScheduleType'],
+            schedule_strategy=plan_args['schedule_strategy'],
+            mindiff=plan_args['mindiff'],
+            doCompletedObservations=completed,
+            cobs=plan_args['cobs'],
+            doPlannedObservations=planned,
+            doMaxTiles=maxtiles,
+            max_nb_tiles=plan_args['max_nb_tiles'],
+            doRASlice=plan_args['doRASlice'],
+            raslice=plan_args['raslice'],
+            doBalanceExposure=plan_args['doBalanceExposure'],
+            airmass=plan_args['airmass'],
+            timer=timer)
+
+    with timer('flat'):
+        params['map_struct'] = dict(zip(
+            ['prob', 'distmu', 'distsigma', 'distnorm'], localization.flat))
 
     if plan_args['usePrevious']:
         previous_telescope, previous_name =\
@@ -537,19 +705,45 @@ def tile(localization_name, dateobs, telescope,
         plan_previous = models.Plan.query.filter_by(
             dateobs=dateobs, telescope=previous_telescope,
             plan_name=previous_name).one()
-        ipix_previous = list({i for planned_observation
-                              in plan_previous.planned_observations
-                              if planned_observation.field.ipix is not None
-                              for i in planned_observation.field.ipix})
+        ipix_previous = plan_previous.ipix
         params['map_struct']['prob'][ipix_previous] = 0.0
 
-    params['is3D'] = localization.is_3d
+    params['is3D'] = 'distmu' in params['map_struct']
     params['localization_name'] = localization_name
-    map_struct, tile_structs, coverage_struct = gen_structs(params)
-
-    for planned_observation in get_planned_observations(
-            params, map_struct, tile_structs, coverage_struct):
-        plan.planned_observations.append(planned_observation)
-    plan.status = plan.Status.READY
-    models.db.session.merge(plan)
+    with tempfile.TemporaryDirectory() as catalog_directory:
+        if params['tilesType'] == 'galaxy':
+            with timer('select_galaxies'):
+                select_galaxies(params, catalog_directory)
+        map_struct, tile_structs, coverage_struct = gen_structs(
+            params, timer)
+
+    with timer('get_planned_observations'):
+        rows = get_planned_observations(
+            params, map_struct, tile_structs, coverage_struct)
+    with timer('insert_planned_observations'):
+        plan = models.db.session.merge(plan)
+        models.PlannedObservation.query.filter_by(
+            dateobs=dateobs, telescope=telescope, plan_name=plan_name
+        ).delete(synchronize_session=False)
+        models.bulk_upsert(models.PlannedObservation, (
+            dict(row, dateobs=dateobs, plan_name=plan_name) for row in rows))
+        # Commit any new fields, so that the summary sees them in the
+        # field table. The plan is not shown until it is ready.
+        models.db.session.commit()
+    with timer('update_summary'):
+        plan.update_summary()
+    with timer('commit'):
+        plan.status = plan.Status.READY
+        models.db.session.commit()
+
+    plan.timings = timer.stages
     models.db.session.commit()
+    views.invalidate_cache(dateobs, telescope, plan_name)
+    log.info('Generated plan %s for %s in %.1f s',
+             plan_name, telescope, plan.planning_time)
+
+    if timer.profiler is not None:
+        timer.dump_stats(os.path.join(
+            app.instance_path, 'profile', '{}_{}_{}.prof'.format(
+                dateobs.strftime('%Y%m%dT%H%M%S'), telescope,
+                urllib.parse.quote(plan_name, safe=''))))
@@ -1,4 +1,6 @@
 import os
+from timeit import default_timer as timer
+
 from astropy import time
 import astropy.units as u
 from astropy.table import Table
@@ -23,15 +25,30 @@ client = PromiseProxy(
 
 @celery.task(base=PeriodicTask, shared=False, run_every=3600)
 def ztf_obs(start_time=None, end_time=None):
+    """Ingest ZTF science images from the IRSA TAP service.
 
-    if start_time is None:
-        start_time = time.Time.now() - time.TimeDelta(1.0*u.day)
+    Parameters
+    ----------
+    start_time : astropy.Time
+        Start time of request. If omitted, then ingest only the images that
+        are newer than an hour before the latest one that has already been
+        ingested (or from the past day, on the first run).
+    end_time : astropy.Time
+        End time of request. Defaults to now.
+
+    """
+    state = models.IngestState.get('ztf_obs')
+    incremental = start_time is None
+    if incremental:
+        # All quadrants of an exposure have the same obsjd, but may be
+        # processed at different times. Ingesting them again is harmless.
+        start_time = state.get_start_time(overlap=1 * u.hour)
     if end_time is None:
         end_time = time.Time.now()
 
     obstable = client.search("""
     SELECT field,rcid,fid,expid,obsjd,exptime,seeing,airmass,maglimit
-    FROM ztf.ztf_current_meta_sci WHERE (obsjd BETWEEN {0} AND {1})
+    FROM ztf.ztf_current_meta_sci WHERE (obsjd > {0} AND obsjd <= {1})
     AND (field < 2000)
     """.format(start_time.jd, end_time.jd)).to_table()
 
@@ -40,37 +57,39 @@ def ztf_obs(start_time=None, end_time=None):
         log.info('No observations in time window to ingest.')
         return
 
-    obs_grouped_by_exp = obstable.group_by('expid').groups
-    for expid, rows in zip(obs_grouped_by_exp.keys, obs_grouped_by_exp):
-        for row in rows:
-            obstime = time.Time(row['obsjd'], format='jd').datetime,
-            models.db.session.merge(
-                models.Observation(telescope='ZTF', field_id=int(row['field']),
-                                   observation_id=int(row['expid']),
-                                   obstime=obstime,
-                                   exposure_time=int(row['exptime']),
-                                   filter_id=int(row['fid']),
-                                   airmass=float(row['airmass']),
-                                   seeing=float(row['seeing']),
-                                   limmag=float(row['maglimit']),
-                                   subfield_id=int(row['rcid']),
-                                   successful=1))
-        subfield_ids = rows['rcid'].tolist()
-        quadrantIDs = np.arange(64)
-        missing_quadrants = np.setdiff1d(quadrantIDs, subfield_ids)
-        for missing_quadrant in missing_quadrants:
-            obstime = time.Time(rows['obsjd'][0], format='jd').datetime,
-            models.db.session.merge(
-                models.Observation(telescope='ZTF',
-                                   field_id=int(rows['field'][0]),
-                                   observation_id=int(rows['expid'][0]),
-                                   obstime=obstime,
-                                   exposure_time=int(rows['exptime'][0]),
-                                   filter_id=int(rows['fid'][0]),
-                                   airmass=float(rows['airmass'][0]),
-                                   subfield_id=int(missing_quadrant),
-                                   successful=0))
+    start = timer()
+    obstimes = time.Time(obstable['obsjd'], format='jd').datetime
+    count = models.bulk_upsert(models.Observation, (
+        dict(telescope='ZTF', field_id=int(row['field']),
+             observation_id=int(row['expid']),
+             obstime=obstime,
+             exposure_time=int(row['exptime']),
+             filter_id=int(row['fid']),
+             airmass=float(row['airmass']),
+             seeing=float(row['seeing']),
+             limmag=float(row['maglimit']),
+             subfield_id=int(row['rcid']),
+             successful=True)
+        for row, obstime in zip(obstable, obstimes)))
+
+    index, missing_quadrants = get_missing_quadrants(
+        obstable['expid'], obstable['rcid'])
+    count += models.bulk_upsert(models.Observation, (
+        dict(telescope='ZTF',
+             field_id=int(row['field']),
+             observation_id=int(row['expid']),
+             obstime=obstime,
+             exposure_time=int(row['exptime']),
+             filter_id=int(row['fid']),
+             airmass=float(row['airmass']),
+             subfield_id=int(missing_quadrant),
+             successful=False)
+        for row, obstime, missing_quadrant in zip(
+            obstable[index], obstimes[index], missing_quadrants)))
+    if incremental:
+        state.advance(obstimes.max())
     models.db.session.commit()
+    log_ingest_rate(count, timer() - start)
 
 
 @celery.task(base=PeriodicTask, shared=False, run_every=3600)
@@ -110,13 +129,15 @@ def ztf_depot(start_time=None, end_time=None):
     Parameters
     ----------
     start_time : astropy.Time
-        Start time of request.
-    end_time : astropy.Time)
-        End time of request.
+        Start time of request. If omitted, then read the nightly summaries
+        from the past day, skipping those that have not changed since the
+        last time that they were read.
+    end_time : astropy.Time
+        End time of request. Defaults to now.
 
     """
-
-    if start_time is None:
+    incremental = start_time is None
+    if incremental:
         start_time = time.Time.now() - time.TimeDelta(1.0*u.day)
     if end_time is None:
         end_time = time.Time.now()
@@ -129,42 +150,110 @@ def ztf_depot(start_time=None, end_time=None):
         dstr = this_time.iso.split(" ")[0].replace("-", "")
 
         url = os.path.join(depotdir, '%s/goodsubs_%s.txt' % (dstr, dstr))
-        deptable = get_ztf_depot_table(url)
+        state = models.IngestState.get(url) if incremental else None
+        deptable = get_ztf_depot_table(url, state=state)
+        if deptable is None:
+            log.info('%s has not changed since it was last read.', url)
+            continue
+        if state is not None:
+            models.db.session.add(state)
         if len(deptable) == 0:
+            models.db.session.commit()
             continue
 
-        obs_grouped_by_jd = deptable.group_by('jd').groups
-        for jd, rows in zip(obs_grouped_by_jd.keys, obs_grouped_by_jd):
-            obstime = time.Time(rows['jd'][0], format='jd').datetime
-            for row in rows:
-                models.db.session.merge(
-                    models.Observation(telescope='ZTF',
-                                       field_id=int(row['field']),
-                                       observation_id=int(row['expid']),
-                                       obstime=obstime,
-                                       limmag=row['scimaglim'],
-                                       exposure_time=int(30),  # fixme
-                                       filter_id=int(row['fid']),
-                                       subfield_id=int(row['rcid']),
-                                       successful=1))
-            subfield_ids = set(rows['rcid'])
-            quadrant_ids = set(range(64))
-            missing_quadrants = quadrant_ids - subfield_ids
-            for missing_quadrant in missing_quadrants:
-                models.db.session.merge(
-                    models.Observation(telescope='ZTF',
-                                       field_id=int(rows['field'][0]),
-                                       observation_id=int(row['expid']),
-                                       obstime=obstime,
-                                       exposure_time=int(30),  # fixme
-                                       filter_id=int(row['fid']),
-                                       subfield_id=int(missing_quadrant),
-                                       successful=0))
-    models.db.session.commit()
+        start = timer()
+        obstimes = time.Time(deptable['jd'], format='jd').datetime
+        count = models.bulk_upsert(models.Observation, (
+            dict(telescope='ZTF',
+                 field_id=int(row['field']),
+                 observation_id=int(row['expid']),
+                 obstime=obstime,
+                 limmag=float(row['scimaglim']),
+                 exposure_time=int(30),  # fixme
+                 filter_id=int(row['fid']),
+                 subfield_id=int(row['rcid']),
+                 successful=True)
+            for row, obstime in zip(deptable, obstimes)))
+
+        index, missing_quadrants = get_missing_quadrants(
+            deptable['expid'], deptable['rcid'])
+        count += models.bulk_upsert(models.Observation, (
+            dict(telescope='ZTF',
+                 field_id=int(row['field']),
+                 observation_id=int(row['expid']),
+                 obstime=obstime,
+                 exposure_time=int(30),  # fixme
+                 filter_id=int(row['fid']),
+                 subfield_id=int(missing_quadrant),
+                 successful=False)
+            for row, obstime, missing_quadrant in zip(
+                deptable[index], obstimes[index], missing_quadrants)))
+        models.db.session.commit()
+        log_ingest_rate(count, timer() - start)
+
+
+def get_missing_quadrants(expids, rcids):
+    """Find the quadrants that are missing from each exposure.
 
+    Parameters
+    ----------
+    expids : numpy.ndarray
+        Exposure ID of each row.
+    rcids : numpy.ndarray
+        Readout channel (quadrant) ID, 0-63, of each row.
+
+    Returns
+    -------
+    index : numpy.ndarray
+        For each missing quadrant, the index of the first row of the same
+        exposure.
+    missing_rcids : numpy.ndarray
+        The readout channel ID of each missing quadrant.
+    """
+    _, first, inverse = np.unique(
+        expids, return_index=True, return_inverse=True)
+    present = np.zeros((len(first), 64), dtype=bool)
+    present[inverse, np.asarray(rcids, dtype=int)] = True
+    exposure, missing_rcids = np.nonzero(~present)
+    return first[exposure], missing_rcids
+
+
+def log_ingest_rate(count, duration):
+    log.info('Ingested %d observation rows in %.1f s (%.0f rows/s)',
+             count, duration, count / max(duration, 1e-9))
+
+
+def get_ztf_depot_table(url, state=None):
+    """Read a table from the ZTF depot.
+
+    Parameters
+    ----------
+    url : str
+        URL of the table.
+    state : growth.too.models.IngestState, optional
+        If provided, then make a conditional request using the cache
+        validators from the previous response, and record the cache
+        validators from this response.
+
+    Returns
+    -------
+    astropy.table.Table
+        The table, or None if the file has not been modified since the
+        previous request.
+    """
+    headers = {}
+    if state is not None:
+        if state.etag is not None:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified is not None:
+            headers['If-Modified-Since'] = state.last_modified
 
-def get_ztf_depot_table(url):
-    with requests.get(url) as r:
+    with requests.get(url, headers=headers) as r:
+        if r.status_code == requests.codes.not_modified:
+            return None
         deptable = Table.read(r.text, format='ascii.fixed_width',
                               data_start=2, data_end=-1)
+        if state is not None:
+            state.etag = r.headers.get('ETag')
+            state.last_modified = r.headers.get('Last-Modified')
     return deptable
@@ -1,15 +1,36 @@
 from unittest.mock import MagicMock
 from unittest.mock import create_autospec
 
+from flask_caching import Cache
 import pytest
 from pytest_socket import socket_allow_hosts
 
 from celery.local import PromiseProxy
 
-from .. import tasks
+from .. import tasks, views
 from ..flask import app
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true',
+                     help='run performance benchmarks')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'benchmark: performance benchmark (run with --benchmark)')
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip benchmarks unless they are explicitly requested."""
+    if config.getoption('benchmark'):
+        return
+    skip = pytest.mark.skip(reason='run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
 def uri_for_proc(proc):
     return f'postgresql://{proc.user}:{proc.password}@{proc.host}:{proc.port}'
 
@@ -42,6 +63,13 @@ def celery(monkeypatch):
     monkeypatch.setitem(tasks.celery.conf, 'task_eager_propagates', True)
 
 
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    """Use an in-process cache instead of Redis."""
+    monkeypatch.setattr(views, 'cache', Cache(app, config={
+        'CACHE_TYPE': 'simple'}))
+
+
 @pytest.fixture
 def mail(monkeypatch):
     """Set the Flask-Mail MAIL_SUPPRESS_SEND flag."""
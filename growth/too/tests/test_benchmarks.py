@@ -0,0 +1,258 @@
+"""Performance benchmarks. These are skipped unless requested with
+``pytest --benchmark``; add ``-m benchmark`` to run only the benchmarks.
+
+The planning benchmarks record their results, and compare them with earlier
+results, through these environment variables:
+
+``BENCHMARK_OUTPUT``
+    Write the results to this JSON file.
+``BENCHMARK_BASELINE``
+    Fail if planning is slower, or encloses less probability, than in the
+    results in this JSON file.
+``BENCHMARK_TOLERANCE``
+    Allowed ratio of planning time to baseline planning time (default 1.5).
+"""
+import datetime
+import itertools
+import json
+import os
+import resource
+import timeit
+
+import numpy as np
+import pytest
+
+from .. import catalogs, datatables, models, views
+from ..flask import app
+from ..tasks import skymaps, tiles
+
+
+def report(name, **timings):
+    print('\n{}: {}'.format(name, ', '.join(
+        '{} {:.3f} s'.format(key, value) for key, value in timings.items())))
+
+
+DATEOBS = datetime.datetime(2019, 4, 25, 8, 18, 5)
+
+TELESCOPES = ['ZTF', 'Gattini', 'DECam', 'KPED', 'GROWTH-India']
+
+# Radii of circular Gaussian localizations. The 90% credible area of a
+# circular Gaussian with standard deviation sigma is 2 ln(10) pi sigma^2.
+LOCALIZATIONS = {
+    'grb': 0.5,
+    '100deg2': np.sqrt(100 / (2 * np.log(10) * np.pi)),
+    '1000deg2': np.sqrt(1000 / (2 * np.log(10) * np.pi)),
+    '1000deg2_3d': np.sqrt(1000 / (2 * np.log(10) * np.pi))
+}
+
+STRATEGIES = {
+    '_'.join(values): dict(zip(
+        ['schedule_strategy', 'schedule_type', 'filterScheduleType'], values))
+    for values in itertools.product(
+        ['tiling', 'catalog'], ['greedy', 'greedy_slew'],
+        ['block', 'integrated'])
+}
+
+
+@pytest.fixture(scope='module')
+def localizations():
+    """Create synthetic localizations of several sizes."""
+    models.db.session.merge(models.Event(dateobs=DATEOBS))
+    models.db.session.commit()
+
+    result = {}
+    for key, radius in LOCALIZATIONS.items():
+        localization_name = skymaps.from_cone(210.0, 30.0, radius, DATEOBS)
+        if key.endswith('_3d'):
+            localization = models.Localization.query.get(
+                (DATEOBS, localization_name))
+            localization_name += '_3d'
+            distmu = np.full(len(localization.uniq), 100.0)
+            distsigma = np.full(len(localization.uniq), 30.0)
+            models.db.session.merge(models.Localization(
+                dateobs=DATEOBS,
+                localization_name=localization_name,
+                uniq=localization.uniq,
+                probdensity=localization.probdensity,
+                distmu=distmu,
+                distsigma=distsigma,
+                distnorm=1 / (np.square(distmu) + np.square(distsigma))))
+            models.db.session.commit()
+        result[key] = localization_name
+    return result
+
+
+@pytest.fixture(scope='module')
+def planning_results():
+    """Collect planning benchmark results, and write them to a file."""
+    results = {}
+    yield results
+    filename = os.environ.get('BENCHMARK_OUTPUT')
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+@pytest.fixture(scope='module')
+def planning_baseline():
+    """Load baseline planning benchmark results, if any."""
+    filename = os.environ.get('BENCHMARK_BASELINE')
+    if not filename:
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('strategy', STRATEGIES)
+@pytest.mark.parametrize('telescope', TELESCOPES)
+@pytest.mark.parametrize('localization_key', LOCALIZATIONS)
+def test_tile(localizations, planning_results, planning_baseline,
+              localization_key, telescope, strategy):
+    """Measure the latency, memory usage, and outcome of observation planning
+    for each telescope, scheduling strategy, and localization size."""
+    key = '/'.join((localization_key, telescope, strategy))
+    localization_name = localizations[localization_key]
+    plan_name = 'benchmark_' + key.replace('/', '_')
+    plan_args = dict(models.Telescope.query.get(telescope).default_plan_args,
+                     **STRATEGIES[strategy])
+
+    tiles.tile(localization_name, DATEOBS, telescope,
+               validity_window_start=DATEOBS,
+               plan_name=plan_name, **plan_args)
+
+    plan = models.Plan.query.get((DATEOBS, telescope, plan_name))
+    localization = models.Localization.query.get(
+        (DATEOBS, localization_name))
+    result = planning_results[key] = dict(
+        wall=plan.planning_time,
+        cpu=sum(stage['cpu'] for stage in plan.timings
+                if stage['depth'] == 0),
+        # Peak resident memory of the process so far, in MB. On Linux,
+        # ru_maxrss is in kilobytes.
+        maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        num_observations=plan.num_observations,
+        probability=float(plan.get_probability(localization)))
+    report(key, wall=result['wall'], cpu=result['cpu'])
+
+    baseline = planning_baseline.get(key)
+    if baseline is not None:
+        tolerance = float(os.environ.get('BENCHMARK_TOLERANCE', 1.5))
+        assert result['wall'] <= tolerance * baseline['wall']
+        assert result['probability'] >= baseline['probability'] - 0.01
+
+
+@pytest.mark.benchmark
+def test_localization_storage():
+    """Compare ingest and read latency of localization arrays stored as
+    PostgreSQL ARRAY columns versus binary columns."""
+    npix = 1000000
+    uniq = np.arange(4 * 512**2, 4 * 512**2 + npix, dtype=np.int64)
+    probdensity = np.random.uniform(size=npix)
+
+    metadata = models.db.MetaData()
+    array_table = models.db.Table(
+        'benchmark_array', metadata,
+        models.db.Column('uniq', models.db.ARRAY(models.db.BigInteger)),
+        models.db.Column('probdensity', models.db.ARRAY(models.db.Float)))
+    binary_table = models.db.Table(
+        'benchmark_binary', metadata,
+        models.db.Column('uniq', models.NumpyArray('<i8')),
+        models.db.Column('probdensity', models.NumpyArray('<f8')))
+
+    engine = models.db.get_engine(app, bind=None)
+    metadata.create_all(engine)
+    try:
+        with engine.connect() as connection:
+            for table, convert in [(array_table, np.ndarray.tolist),
+                                   (binary_table, np.asarray)]:
+                def ingest():
+                    connection.execute(table.insert().values(
+                        uniq=convert(uniq),
+                        probdensity=convert(probdensity)))
+
+                def read():
+                    for row in connection.execute(table.select()):
+                        np.asarray(row.uniq)
+                        np.asarray(row.probdensity)
+
+                report(table.name,
+                       ingest=timeit.timeit(ingest, number=1),
+                       read=timeit.timeit(read, number=1))
+
+            row, = connection.execute(binary_table.select())
+            np.testing.assert_array_equal(row.uniq, uniq)
+            np.testing.assert_array_equal(row.probdensity, probdensity)
+    finally:
+        metadata.drop_all(engine)
+
+
+@pytest.mark.benchmark
+def test_datatables():
+    """Measure the latency of serving a page of the galaxy catalog, sorted by
+    one or two columns."""
+    columns = list(catalogs.galaxies.columns.values())
+    names = catalogs.galaxies.colnames
+    requests = {
+        'unsorted': {},
+        'filtered': {
+            'columns[{}][search][value]'.format(
+                names.index('distmpc')): json.dumps({'max': 100})},
+        'sorted': {
+            'order[0][column]': str(names.index('distmpc')),
+            'order[0][dir]': 'desc'},
+        'sorted by two columns': {
+            'order[0][column]': str(names.index('name')),
+            'order[1][column]': str(names.index('distmpc'))}}
+    timings = {}
+    for key, args in requests.items():
+        args = dict(args, start='100', length='100')
+        timings[key] = timeit.timeit(
+            lambda: datatables.process(columns, args), number=10) / 10
+    report('datatables', **timings)
+
+
+@pytest.mark.benchmark
+def test_json_export():
+    """Compare the latency of exporting a 2000-exposure DECam plan by
+    lazy-loading the field of each planned observation versus by a single
+    joined query."""
+    models.db.session.merge(models.Event(dateobs=DATEOBS))
+    key = (DATEOBS, 'DECam', 'benchmark_json_export')
+    models.db.session.merge(models.Plan(
+        dateobs=DATEOBS, telescope='DECam', plan_name=key[2],
+        validity_window_start=DATEOBS,
+        validity_window_end=DATEOBS + datetime.timedelta(days=1),
+        plan_args={'doReferences': True, 'doDither': True}))
+    models.db.session.commit()
+    field_ids = [field_id for field_id, in models.db.session.query(
+        models.Field.field_id).filter_by(telescope='DECam')]
+    models.bulk_upsert(models.PlannedObservation, (
+        dict(planned_observation_id=i, dateobs=DATEOBS, telescope='DECam',
+             field_id=field_id, plan_name=key[2], exposure_time=30,
+             weight=1.0, filter_id=1 + i % 2,
+             obstime=DATEOBS + datetime.timedelta(minutes=i),
+             overhead_per_exposure=10)
+        for i, field_id in zip(range(2000), itertools.cycle(field_ids))))
+    models.Plan.query.get(key).update_summary()
+    models.db.session.commit()
+
+    def lazy():
+        models.db.session.expunge_all()
+        return [
+            (exposure.field_id, exposure.field.ra, exposure.field.dec,
+             exposure.filter_id, exposure.exposure_time,
+             exposure.field.reference_filter_ids)
+            for exposure in models.Plan.query.get(key).planned_observations]
+
+    def joined():
+        models.db.session.expunge_all()
+        return views.get_plan_exposures(models.Plan.query.get(key))
+
+    assert lazy() == [tuple(row) for row in joined()]
+    report('json_export',
+           lazy=timeit.timeit(lazy, number=1),
+           joined=timeit.timeit(joined, number=1),
+           get_json_data=timeit.timeit(
+               lambda: views.get_json_data(models.Plan.query.get(key)),
+               number=1))
@@ -0,0 +1,51 @@
+import healpy as hp
+import numpy as np
+from astropy.table import Table
+
+from .. import catalogs
+
+
+def test_galaxies_in_region(tmpdir):
+    nside = 256
+    ra = np.asarray(catalogs.galaxies['ra'])
+    dec = np.asarray(catalogs.galaxies['dec'])
+
+    # A disk that straddles several pixels of the index.
+    region = np.zeros(hp.nside2npix(nside), dtype=bool)
+    region[hp.query_disc(nside, hp.ang2vec(180.0, 20.0, lonlat=True),
+                         np.deg2rad(10.0))] = True
+
+    expected = np.flatnonzero(region[hp.ang2pix(nside, ra, dec, lonlat=True)])
+    rows = catalogs.galaxies_in_region(region)
+    assert len(rows) > 0
+    np.testing.assert_array_equal(rows, expected)
+
+    # The whole sky contains every galaxy.
+    np.testing.assert_array_equal(
+        catalogs.galaxies_in_region(np.ones_like(region)),
+        np.arange(len(catalogs.galaxies)))
+
+    # Write the galaxies in the region to a catalog for gwemopt.
+    filename = str(tmpdir / 'CLU.hdf5')
+    catalogs.write_galaxies(filename, rows)
+    table = Table.read(filename)
+    np.testing.assert_array_equal(table['ra'], ra[rows])
+    assert '2D CL' not in table.colnames
+
+
+def test_memory_mapped_catalog():
+    galaxies = catalogs.get_from_package('CLU.hdf5')
+    filepath = catalogs.pkg_resources.resource_filename(
+        catalogs.__name__, 'catalog/CLU.hdf5')
+    expected = catalogs.fixup(Table.read(filepath))
+
+    assert galaxies.colnames == expected.colnames
+    for name in ['name', 'ra', 'distmpc', '2D CL']:
+        column = galaxies[name]
+        # The columns are shared, read-only memory maps.
+        assert not np.ma.getdata(column).flags.writeable
+        np.testing.assert_array_equal(column.mask, expected[name].mask)
+        np.testing.assert_array_equal(
+            column.data.data, expected[name].data.data)
+        assert column.unit == expected[name].unit
+        assert column.format == expected[name].format
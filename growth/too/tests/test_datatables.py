@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pytest
+
+from .. import datatables
+
+
+@pytest.fixture
+def columns():
+    name = np.asarray(['a', 'b', 'c', 'd', 'e'])
+    value = np.ma.masked_invalid([3.14159, np.nan, 1.0, 2.5, 1.0])
+    count = np.asarray([5, 4, 3, 2, 1])
+    return [name, value, count]
+
+
+def column_data(result, i):
+    return [row[i] for row in result['data']]
+
+
+def test_process(columns):
+    result = datatables.process(columns, {'draw': '7'})
+    assert result['draw'] == 7
+    assert result['recordsTotal'] == result['recordsFiltered'] == 5
+    assert result['data'][:2] == [('a', 3.14159, 5), ('b', None, 4)]
+
+
+def test_filter(columns):
+    result = datatables.process(columns, {
+        'columns[1][search][value]': json.dumps({'min': 1.5}),
+        'columns[2][search][value]': json.dumps({'max': 4})})
+    assert result['recordsTotal'] == 5
+    assert result['recordsFiltered'] == 1
+    assert column_data(result, 0) == ['d']
+
+
+@pytest.mark.parametrize('start,length', [(0, 2), (1, 3), (0, -1)])
+def test_sort(columns, start, length):
+    args = {'order[0][column]': '1', 'order[0][dir]': 'desc',
+            'start': str(start), 'length': str(length)}
+    expected = ['a', 'd', 'c', 'e', 'b']
+    stop = None if length < 0 else start + length
+    assert column_data(
+        datatables.process(columns, args), 0) == expected[start:stop]
+
+    # Break ties with a second column.
+    args.update({'order[1][column]': '2', 'order[1][dir]': 'asc'})
+    expected = ['a', 'd', 'e', 'c', 'b']
+    assert column_data(
+        datatables.process(columns, args), 0) == expected[start:stop]
+
+
+@pytest.mark.parametrize('args', [
+    {'draw': 'foo'},
+    {'start': 'foo'},
+    {'order[0][column]': '3'},
+    {'columns[2][search][value]': json.dumps({'min': 'foo'})}])
+def test_invalid(columns, args):
+    with pytest.raises(ValueError):
+        datatables.process(columns, args)
@@ -1,4 +1,5 @@
 import datetime
+import os
 from unittest import mock
 
 from astropy import time
@@ -24,11 +25,14 @@ def test_freeze_time():
     assert time.Time.now() == time.Time('2017-08-17')
 
 
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
 @mock.patch('growth.too.tasks.skymaps.from_cone.run')
 def test_grb180116a_gnd_pos(mock_from_cone, mock_tile, mock_contour,
-                            celery, flask, mail):
+                            mock_crossmatch, mock_render_plots, celery, flask,
+                            mail):
     # Read test GCN
     payload = pkg_resources.resource_string(
         __name__, 'data/GRB180116A_Fermi_GBM_Gnd_Pos.xml')
@@ -76,6 +80,21 @@ def test_grb180116a_fin_pos(mock_call_everyone, mock_slack_everyone,
 
     localization, = event.localizations
     assert np.isclose(localization.flat_2d.sum(), 1.0)
+    assert os.path.exists(localization._crossmatch_cache_filename('CLU'))
+
+    # The observability and airmass plots are rendered ahead of time.
+    today = datetime.date(2019, 8, 21)
+    for date in [today, today + datetime.timedelta(days=1)]:
+        assert os.path.exists(
+            localization._plot_cache_filename('observability', date))
+        assert os.path.exists(
+            localization._plot_cache_filename('airmass_ZTF', date))
+    with mock.patch.dict(app.config, {'LOGIN_DISABLED': True}):
+        response = flask.get(
+            '/event/{}/observability/ZTF/{}/{}/airmass.png'.format(
+                dateobs, localization.localization_name, today))
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
 
     telescope = 'ZTF'
     filt = ['g', 'r', 'g']
@@ -107,6 +126,28 @@ def test_grb180116a_fin_pos(mock_call_everyone, mock_slack_everyone,
         assert np.all(np.array(exposure.weight) <= 1)
 
     assert np.isclose(plan.area, 651.6459456904389)
+    assert plan.summary['num_observations'] == len(exposures)
+
+    matrix = models.Plan.get_coverage_matrix([plan])
+    np.testing.assert_array_equal(
+        np.flatnonzero(matrix[0].toarray()), plan.ipix)
+    assert np.isclose((matrix @ localization.flat_2d)[0],
+                      plan.get_probability(localization))
+    total_time = plan.total_time
+    assert total_time == sum(exposure.exposure_time for exposure in exposures)
+
+    # Editing the planned observations updates the stored summary.
+    exposures[0].exposure_time += 60
+    models.db.session.commit()
+    assert plan.summary['total_time'] == total_time + 60
+    assert plan.total_time == total_time + 60
+    exposures[0].exposure_time -= 60
+    models.db.session.commit()
+
+    stages = [stage['stage'] for stage in plan.timings]
+    assert stages[:2] == ['params_struct', 'get_telescope_segments']
+    assert 'coverage.timeallocation' in stages
+    assert plan.planning_time > 0
 
     # Try submitting some of the observing plans.
     flask.post(
@@ -118,12 +159,15 @@ def test_grb180116a_fin_pos(mock_call_everyone, mock_slack_everyone,
     )
 
 
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
 @mock.patch('growth.too.tasks.skymaps.from_cone.run')
 @mock.patch('growth.too.tasks.skymaps.download.run')
 def test_grb180116a_multiple_gcns(mock_download, mock_from_cone, mock_tile,
-                                  mock_contour, celery, flask, mail):
+                                  mock_contour, mock_crossmatch,
+                                  mock_render_plots, celery, flask, mail):
     """Test reading and ingesting all three GCNs. Make sure that there are
     no database conflicts."""
     for notice_type in ['Alert', 'Flt_Pos', 'Gnd_Pos', 'Fin_Pos']:
@@ -138,14 +182,16 @@ def test_grb180116a_multiple_gcns(mock_download, mock_from_cone, mock_tile,
 @mock.patch('growth.too.tasks.twilio.text_everyone.run')
 @mock.patch('growth.too.tasks.twilio.call_everyone.run')
 @mock.patch('growth.too.tasks.slack.slack_everyone.run')
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
 @mock.patch('growth.too.tasks.skymaps.from_cone.run')
 @mock.patch('astropy.io.fits.file.download_file', mock_download_file)
 def test_gbm_subthreshold(mock_from_cone, mock_tile, mock_contour,
+                          mock_crossmatch, mock_render_plots,
                           mock_call_everyone, mock_text_everyone,
-                          mock_slack_everyone, celery,
-                          flask, mail):
+                          mock_slack_everyone, celery, flask, mail):
     """Test reading and ingesting all three GCNs. Make sure that there are
     no database conflicts."""
     filename = 'data/GRB180422.913_Subthreshold.xml'
@@ -165,11 +211,13 @@ def test_gbm_subthreshold(mock_from_cone, mock_tile, mock_contour,
     mock_slack_everyone.assert_not_called()
 
 
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
 @mock.patch('growth.too.tasks.skymaps.from_cone.run')
 def test_amon_151115(mock_from_cone, mock_tile, mock_contour,
-                     celery, flask, mail):
+                     mock_crossmatch, mock_render_plots, celery, flask, mail):
     # Read test GCN
     payload = pkg_resources.resource_string(
         __name__, 'data/AMON_151115.xml')
@@ -183,11 +231,14 @@ def test_amon_151115(mock_from_cone, mock_tile, mock_contour,
     assert event.tags == ['AMON']
 
 
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
 @mock.patch('growth.too.tasks.skymaps.from_cone.run')
 def test_amon_icecube_gold_190730(mock_from_cone, mock_tile, mock_contour,
-                                  celery, flask, mail):
+                                  mock_crossmatch, mock_render_plots, celery,
+                                  flask, mail):
     # Read test GCN
     payload = pkg_resources.resource_string(
         __name__, 'data/AMON_ICECUBE_GOLD_190730.xml')
@@ -201,11 +252,14 @@ def test_amon_icecube_gold_190730(mock_from_cone, mock_tile, mock_contour,
     assert event.tags == ['AMON']
 
 
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
 @mock.patch('growth.too.tasks.skymaps.from_cone.run')
 def test_amon_icecube_bronze_190819(mock_from_cone, mock_tile, mock_contour,
-                                    celery, flask, mail):
+                                    mock_crossmatch, mock_render_plots, celery,
+                                    flask, mail):
     # Read test GCN
     payload = pkg_resources.resource_string(
         __name__, 'data/AMON_ICECUBE_BRONZE_190819.xml')
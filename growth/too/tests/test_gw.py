@@ -8,9 +8,12 @@ from ..gcn import handle
 
 
 @mock.patch('growth.too.tasks.skymaps.download.run')
+@mock.patch('growth.too.tasks.skymaps.render_plots.run')
+@mock.patch('growth.too.tasks.skymaps.crossmatch_galaxies.run')
 @mock.patch('growth.too.tasks.skymaps.contour.run')
 @mock.patch('growth.too.tasks.tiles.tile.run')
-def test_lvc(mock_tile, mock_contour, mock_download, celery, flask, mail):
+def test_lvc(mock_tile, mock_contour, mock_crossmatch, mock_render_plots,
+             mock_download, celery, flask, mail):
     """Very basic test of LIGO/Virgo GCN parsing."""
     # Read test GCN
     payload = pkg_resources.resource_string(
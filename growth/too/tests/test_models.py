@@ -0,0 +1,123 @@
+import datetime
+import os
+
+import numpy as np
+
+from .. import catalogs, models
+from ..tasks import skymaps
+
+
+def test_flat_cache():
+    dateobs = datetime.datetime(2019, 1, 2, 3, 4, 5)
+    models.db.session.merge(models.Event(dateobs=dateobs))
+    models.db.session.commit()
+    localization_name = skymaps.from_cone(10.0, 20.0, 5.0, dateobs)
+    localization = models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one()
+    filename = localization._flat_cache_filename('PROB')
+
+    # Creating the localization populates the cache.
+    assert os.path.exists(filename)
+    prob = np.array(localization.flat_2d)
+    assert np.isclose(prob.sum(), 1.0)
+
+    # Subsequent accesses read the same data back from the cache.
+    np.testing.assert_array_equal(localization.flat_2d, prob)
+    np.testing.assert_array_equal(localization.flat[0], prob)
+
+    # Replacing the localization discards the cache, but only once the change
+    # is committed.
+    localization.probdensity = localization.probdensity[::-1]
+    models.db.session.flush()
+    assert os.path.exists(filename)
+    models.db.session.commit()
+    assert not os.path.exists(filename)
+    assert not np.array_equal(localization.flat_2d, prob)
+
+
+def test_coverage_matrix():
+    field_ids = [300, 301, 302]
+    fields = models.Field.query.filter(
+        models.Field.telescope == 'ZTF',
+        models.Field.field_id.in_(field_ids))
+    expected = sorted({i for field in fields for i in field.ipix})
+
+    coverage = models.Field.get_coverage('ZTF')
+    np.testing.assert_array_equal(coverage.ipix(field_ids), expected)
+
+    # A second lookup in the same process reuses the same matrix.
+    assert models.Field.get_coverage('ZTF') is coverage
+
+    # Edits only discard the cached matrix once they are committed.
+    field = models.Field.query.get(('ZTF', 300))
+    field.ipix = field.ipix[:1]
+    models.db.session.flush()
+    assert models.Field.get_coverage('ZTF') is coverage
+    models.db.session.rollback()
+    assert models.Field.get_coverage('ZTF') is coverage
+
+    prob = np.ones(coverage.matrix.shape[1])
+    assert coverage.probability(field_ids, prob) == len(expected)
+    assert coverage.probabilities(prob)[coverage.rows([300])] == len(
+        models.Field.query.get(('ZTF', 300)).ipix)
+
+    # The same table gives the positions and reference filters of many
+    # fields at once.
+    rows = coverage.find(field_ids + [-1])
+    assert rows[-1] == -1
+    for field, row in zip(fields.order_by(models.Field.field_id), rows):
+        assert coverage.ra[row] == field.ra
+        assert coverage.dec[row] == field.dec
+        for filter_id in range(1, 6):
+            assert coverage.has_reference(row, filter_id) == (
+                filter_id in field.reference_filter_ids)
+
+
+def test_galaxy_crossmatch():
+    dateobs = datetime.datetime(2019, 1, 3, 4, 5, 6)
+    models.db.session.merge(models.Event(dateobs=dateobs))
+    models.db.session.commit()
+    localization_name = skymaps.from_cone(20.0, 30.0, 5.0, dateobs)
+    localization = models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one()
+    filename = localization._crossmatch_cache_filename('CLU')
+
+    result = catalogs.get_crossmatch(localization)
+    assert os.path.exists(filename)
+    assert len(result['searched_prob']) == len(catalogs.galaxies)
+
+    # Subsequent calls read the same results back from the cache.
+    np.testing.assert_array_equal(
+        catalogs.get_crossmatch(localization)['searched_prob'],
+        result['searched_prob'])
+
+
+def test_candidate_crossmatch():
+    dateobs = datetime.datetime(2019, 1, 4, 5, 6, 7)
+    models.db.session.merge(models.Event(dateobs=dateobs))
+    for name, ra, dec in [('ZTF19aaaaaaa', 30.0, 40.0),
+                          ('ZTF19aaaaaab', 200.0, -40.0)]:
+        models.db.session.merge(models.Candidate(
+            name=name, growth_marshal_id=name, ra=ra, dec=dec,
+            last_updated=dateobs))
+    models.db.session.commit()
+    localization_name = skymaps.from_cone(30.0, 40.0, 5.0, dateobs)
+    localization = models.Localization.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).one()
+
+    # Only candidates that have not been crossmatched yet are updated.
+    assert models.CandidateCrossmatch.update(localization) >= 2
+    models.db.session.commit()
+    assert models.CandidateCrossmatch.update(localization) == 0
+    inside = models.CandidateCrossmatch.query.get(
+        (dateobs, localization_name, 'ZTF19aaaaaaa'))
+    outside = models.CandidateCrossmatch.query.get(
+        (dateobs, localization_name, 'ZTF19aaaaaab'))
+    assert inside.searched_prob < 0.5 < outside.searched_prob
+    assert inside.probdensity > outside.probdensity
+
+    # Replacing the localization discards the stored crossmatch.
+    localization.probdensity = localization.probdensity[::-1]
+    models.db.session.commit()
+    assert models.CandidateCrossmatch.query.filter_by(
+        dateobs=dateobs, localization_name=localization_name).count() == 0
@@ -0,0 +1,40 @@
+import json
+
+from ..flask import app
+from ..tasks import scheduler
+
+
+def test_ztf_queue(httpserver, monkeypatch, cache, flask):
+    monkeypatch.setattr(scheduler, 'ZTF_URL', httpserver.url_for('/'))
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+
+    httpserver.expect_oneshot_request(
+        '/queues', method='GET'
+    ).respond_with_json([{'queue_name': 'default'},
+                         {'queue_name': 'ToO_GW'}])
+
+    httpserver.expect_oneshot_request(
+        '/current_queue', method='GET'
+    ).respond_with_json({
+        'queue_name': 'ToO_GW',
+        'queue_type': 'list',
+        'queue': json.dumps([
+            {'field_id': 300, 'ra': 10.0, 'dec': 20.0, 'filter_id': 1,
+             'program_id': 2, 'subprogram_name': 'ToO', 'ordered': True},
+            {'field_id': 301, 'ra': 11.0, 'dec': 21.0, 'filter_id': 2,
+             'program_id': 2, 'subprogram_name': 'ToO', 'ordered': True}])
+    })
+
+    snapshot = scheduler.get_ztf_queue()
+    assert snapshot['queue_names'] == ['default', 'ToO_GW']
+    assert snapshot['queue_name'] == 'ToO_GW'
+    assert list(snapshot['queue']['field_id']) == [300, 301]
+    assert 'Number of unique field_ids: 2' in snapshot['queue_info']
+
+    # Later requests are served from the snapshot, without contacting the
+    # scheduler again.
+    assert scheduler.get_ztf_queue()['time'] == snapshot['time']
+    response = flask.get('/queue/')
+    assert response.status_code == 200
+    assert b'ToO_GW' in response.data
+    httpserver.check_assertions()
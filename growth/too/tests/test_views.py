@@ -0,0 +1,112 @@
+import datetime
+
+from .. import models, views
+from ..flask import app
+from ..tasks import skymaps
+
+
+def test_cache_invalidation(monkeypatch, flask):
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+    dateobs = datetime.datetime(2019, 1, 5, 6, 7, 8)
+    models.db.session.merge(models.Event(dateobs=dateobs))
+    models.db.session.commit()
+    localization_name = skymaps.from_cone(40.0, 50.0, 5.0, dateobs)
+    url = '/event/{}/localization/{}/json'.format(
+        dateobs.isoformat(), localization_name)
+
+    # Computing the contour replaces the cached response.
+    skymaps.contour(localization_name, dateobs)
+    response = flask.get(url)
+    assert response.status_code == 200
+    assert response.json['type'] == 'FeatureCollection'
+
+    # Changes that are made without invalidating the cache are not seen...
+    localization = models.Localization.query.get(
+        (dateobs, localization_name))
+    localization.contour = {'type': 'FeatureCollection', 'features': []}
+    models.db.session.commit()
+    assert flask.get(url).json['features']
+
+    # ...until the cache is invalidated.
+    views.invalidate_cache(dateobs, localization_name=localization_name)
+    assert flask.get(url).json['features'] == []
+
+
+def test_conditional_get(monkeypatch, flask):
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+    dateobs = datetime.datetime(2019, 1, 6, 7, 8, 9)
+    models.db.session.merge(models.Event(dateobs=dateobs))
+    models.db.session.commit()
+    localization_name = skymaps.from_cone(50.0, 60.0, 5.0, dateobs)
+    skymaps.contour(localization_name, dateobs)
+    url = '/event/{}/localization/{}/json'.format(
+        dateobs.isoformat(), localization_name)
+
+    response = flask.get(url)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] in {
+        'private, no-cache', 'no-cache, private'}
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    # A client that already has the current version gets an empty response.
+    response = flask.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert not response.data
+    response = flask.get(url, headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+
+    # A changed resource gets a new ETag.
+    localization = models.Localization.query.get(
+        (dateobs, localization_name))
+    localization.contour = {'type': 'FeatureCollection', 'features': []}
+    models.db.session.commit()
+    views.invalidate_cache(dateobs, localization_name=localization_name)
+    response = flask.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_objects_data(monkeypatch, flask, celery):
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+    dateobs = datetime.datetime(2019, 1, 7, 8, 9, 10)
+    models.db.session.merge(models.Event(dateobs=dateobs))
+    models.db.session.commit()
+    skymaps.from_cone(60.0, 70.0, 5.0, dateobs)
+    for i, name in enumerate(['ZTF19aaaaaaa', 'ZTF19aaaaaab']):
+        models.db.session.merge(models.Candidate(
+            name=name, growth_marshal_id=name, ra=61.25, dec=70.0 + i,
+            last_updated=dateobs, photometry=[
+                models.CandidatePhotometry(
+                    dateobs=dateobs + datetime.timedelta(days=j - i),
+                    mag=18.0 + j)
+                for j in range(3)]))
+    models.db.session.commit()
+    url = '/event/{}/objects/json'.format(dateobs.isoformat())
+    # Select only the candidates of this test.
+    args = {'columns[1][search][value]': '{"min": 61.25, "max": 61.25}'}
+
+    # Only the requested page is returned, sorted by first detection.
+    response = flask.get(url, query_string=dict(
+        args, **{'draw': '1', 'order[0][column]': '6',
+                 'order[0][dir]': 'asc', 'start': '0', 'length': '1'}))
+    assert response.status_code == 200
+    result = response.json
+    assert result['draw'] == 1
+    assert result['recordsFiltered'] == 2
+    row, = result['data']
+    assert row[0] == 'ZTF19aaaaaab'
+    assert row[6] == (dateobs - datetime.timedelta(days=1)).isoformat()
+    assert row[7] == 18.0
+
+    # Filters are applied by the database.
+    response = flask.get(url, query_string=dict(
+        args, **{'columns[2][search][value]': '{"min": 70.5}'}))
+    result = response.json
+    assert result['recordsFiltered'] == 1
+    assert [row[0] for row in result['data']] == ['ZTF19aaaaaab']
+
+    # Malformed requests are rejected.
+    response = flask.get(url, query_string={
+        'columns[6][search][value]': '{"min": "foo"}'})
+    assert response.status_code == 400
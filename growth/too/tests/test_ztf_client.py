@@ -2,6 +2,8 @@ from unittest.mock import Mock, MagicMock
 
 from astropy.table import Table
 from astropy import time
+import astropy.units as u
+import numpy as np
 import pkg_resources
 import pytest
 
@@ -63,6 +65,19 @@ def test_obs(mock_obsclient):
     assert observation.limmag == 20.895300
 
 
+def test_obs_incremental(mock_obsclient, mock_obstable):
+    ztf_client.ztf_obs()
+    state = models.IngestState.query.get('ztf_obs')
+    assert state.watermark == time.Time(
+        mock_obstable['obsjd'].max(), format='jd').datetime
+
+    # The next run only asks for newer observations, with some overlap.
+    ztf_client.ztf_obs()
+    query, = mock_obsclient.search.call_args[0]
+    assert 'obsjd > {}'.format(
+        (time.Time(state.watermark) - 1 * u.hour).jd) in query
+
+
 @pytest.fixture
 def mock_deptable():
     filename = 'data/ztf_depot_table.dat'
@@ -91,3 +106,25 @@ def test_depot(mock_get_ztf_depot_table):
                                                      subfield_id=45).one()
     assert observation.field_id == 518
     assert observation.limmag == 19.6
+
+
+def test_get_missing_quadrants():
+    expids = np.asarray([2, 1, 2, 1])
+    rcids = np.asarray([0, 5, 1, 63])
+    index, missing_rcids = ztf_client.get_missing_quadrants(expids, rcids)
+    assert len(index) == len(missing_rcids) == 2 * 62
+    assert set(expids[index]) == {1, 2}
+    assert set(missing_rcids[expids[index] == 1]) == set(range(64)) - {5, 63}
+    assert set(missing_rcids[expids[index] == 2]) == set(range(64)) - {0, 1}
+
+
+def test_get_ztf_depot_table_not_modified(monkeypatch):
+    response = Mock(status_code=304)
+    get = MagicMock()
+    get.return_value.__enter__.return_value = response
+    monkeypatch.setattr('requests.get', get)
+    state = models.IngestState(source='https://example.edu/goodsubs.txt',
+                               etag='"abc"')
+
+    assert ztf_client.get_ztf_depot_table(state.source, state) is None
+    assert get.call_args[1]['headers'] == {'If-None-Match': '"abc"'}
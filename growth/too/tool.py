@@ -75,6 +75,29 @@ def passwd(username):
     htpasswd.save(path)
 
 
+@app.cli.command()
+@click.argument('source', type=click.Choice(
+    ['ztf_obs', 'ztf_depot', 'gattini_obs']))
+@click.argument('start')
+@click.argument('end', required=False)
+def backfill(source, start, end):
+    """Ingest observations from SOURCE between START and END.
+
+    START and END are UTC times in ISO 8601 format; END defaults to now.
+    Scheduled ingestion only fetches observations that are newer than the
+    latest one that has already been ingested, so use this command to
+    (re-)ingest an arbitrary time range, for example to fill in a gap after
+    an outage.
+    """
+    from astropy.time import Time
+
+    task = {'ztf_obs': tasks.ztf_client.ztf_obs,
+            'ztf_depot': tasks.ztf_client.ztf_depot,
+            'gattini_obs': tasks.gattini_client.gattini_obs}[source]
+    task(start_time=Time(start, scale='utc'),
+         end_time=None if end is None else Time(end, scale='utc'))
+
+
 @app.cli.group()
 def db():
     """Manage the PostgreSQL database."""
@@ -82,9 +105,12 @@ def db():
 
 @db.command()
 @click.option('--sample', is_flag=True, help="Populate with sample data.")
-def create(sample):
+@click.option('--jobs', '-j', type=int, default=1, show_default=True,
+              help="Number of processes for calculating field footprints "
+              "(0 for one per CPU).")
+def create(sample, jobs):
     """Create all tables from SQLAlchemy models"""
-    models.create_all()
+    models.create_all(processes=jobs or None)
     models.db.session.commit()
 
     if sample:
@@ -127,10 +153,121 @@ def drop(preserve):
     models.db.session.commit()
 
 
+@db.command()
+def upgrade():
+    """Add new tables and columns to an existing database.
+
+    Create any tables that do not exist yet, and add any columns that have
+    been added to the models since the database was created. Only nullable
+    columns can be added this way. Finally, store the summary statistics of
+    any plans that do not have them yet.
+    """
+    engine = models.db.get_engine(app, bind=None)
+    models.db.create_all(bind=None)
+    inspector = models.db.inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+
+    with engine.begin() as connection:
+        for table in models.db.metadata.sorted_tables:
+            existing = {
+                column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    raise click.ClickException(
+                        'Cannot add non-nullable column {}.{}'.format(
+                            table.name, column.name))
+                click.echo('Adding column {}.{}'.format(
+                    table.name, column.name))
+                connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(engine.dialect)))
+
+    plans = models.Plan.query.filter(
+        models.Plan.summary.is_(None) |
+        (models.db.cast(models.Plan.summary, models.db.Text) == 'null')
+    ).all()
+    for plan in tqdm(plans, 'Storing plan summaries'):
+        plan.update_summary()
+        models.db.session.commit()
+
+
+@db.command('migrate-localizations')
+@click.option('--batch-size', type=int, default=100, show_default=True,
+              help="Number of localizations to convert at a time.")
+def migrate_localizations(batch_size):
+    """Convert localization arrays to binary columns.
+
+    Older databases store the multiresolution HEALPix arrays of each
+    localization as PostgreSQL ARRAY columns. Convert them in place to the
+    binary format used by the current models, reading the localizations in
+    batches in order of their primary key so that only one batch is held in
+    memory at a time.
+    """
+    table = models.Localization.__table__
+    columns = ['uniq', 'probdensity', 'distmu', 'distsigma', 'distnorm']
+    engine = models.db.get_engine(app, bind=None)
+
+    with engine.begin() as connection:
+        data_types = dict(connection.execute(
+            models.db.text(
+                "SELECT column_name, data_type "
+                "FROM information_schema.columns "
+                "WHERE table_name = 'localization'")))
+        columns = [column for column in columns
+                   if data_types.get(column) == 'ARRAY']
+        if not columns:
+            click.echo('Nothing to do.')
+            return
+
+        for column in columns:
+            connection.execute(
+                'ALTER TABLE localization RENAME COLUMN {0} TO {0}_old'.format(
+                    column))
+            connection.execute(
+                'ALTER TABLE localization ADD COLUMN {} bytea'.format(column))
+
+        key = models.db.tuple_(table.c.dateobs, table.c.localization_name)
+        query = models.db.select(
+            [table.c.dateobs, table.c.localization_name] +
+            [models.db.column(column + '_old') for column in columns]
+        ).select_from(table).order_by(
+            table.c.dateobs, table.c.localization_name).limit(batch_size)
+        count = connection.execute(
+            models.db.select([models.db.func.count()]).select_from(table)
+        ).scalar()
+        rows = connection.execute(query).fetchall()
+        with tqdm(total=count, desc='converting localizations') as progress:
+            while rows:
+                for dateobs, localization_name, *values in rows:
+                    connection.execute(
+                        table.update().where(
+                            (table.c.dateobs == dateobs) &
+                            (table.c.localization_name == localization_name)
+                        ).values(dict(zip(columns, values))))
+                progress.update(len(rows))
+                rows = connection.execute(query.where(
+                    key > models.db.tuple_(dateobs, localization_name)
+                )).fetchall()
+
+        for column in columns:
+            connection.execute(
+                'ALTER TABLE localization DROP COLUMN {}_old'.format(column))
+            if not table.c[column].nullable:
+                connection.execute(
+                    'ALTER TABLE localization '
+                    'ALTER COLUMN {} SET NOT NULL'.format(column))
+
+
 @db.command()
 @click.option('--sample', is_flag=True, help="Populate with sample data.")
+@click.option('--jobs', '-j', type=int, default=1, show_default=True,
+              help="Number of processes for calculating field footprints "
+              "(0 for one per CPU).")
 @click.pass_context
-def recreate(ctx, sample):
+def recreate(ctx, sample, jobs):
     """Drop and recreate all tables from SQLAlchemy models"""
     ctx.invoke(drop)
     ctx.forward(create)
@@ -1,5 +1,5 @@
 import datetime
-import json
+import functools
 import os
 import urllib.parse
 import math
@@ -7,25 +7,20 @@ import re
 import requests
 import shutil
 import tempfile
+import uuid
 
 from celery import group
+import healpy as hp
 import numpy as np
-from astropy.coordinates import SkyCoord
 from astropy import time
 import astropy.units as u
-from astropy.table import Table
-import pandas as pd
+from astropy.table import MaskedColumn
 from ligo.skymap import io
-from ligo.skymap.postprocess import crossmatch
-from ligo.skymap.tool.ligo_skymap_plot_airmass import main as plot_airmass
-from ligo.skymap.tool.ligo_skymap_plot_observability import main \
-    as plot_observability
-import matplotlib.style
 import pkg_resources
 
 from flask import (
     abort, flash, jsonify, make_response, redirect, render_template, request,
-    Response, url_for)
+    Response, send_file, url_for)
 from flask_caching import Cache
 from flask_login import (
     current_user, login_required, login_user, logout_user, LoginManager)
@@ -40,7 +35,7 @@ from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from .flask import app
 from .jinja import atob
-from . import catalogs, models, tasks
+from . import catalogs, datatables, models, tasks
 from ._version import get_versions
 #
 #
@@ -76,6 +71,124 @@ cache = Cache(app, config={
     'CACHE_REDIS_HOST': tasks.celery.backend.client,
     'CACHE_TYPE': 'redis'})
 
+# View arguments that identify the event, plan, or localization on which a
+# cached view depends.
+CACHE_TAGS = {
+    'event': ('dateobs',),
+    'plan': ('dateobs', 'telescope', 'plan_name'),
+    'localization': ('dateobs', 'localization_name')}
+
+
+def _cache_tag(kind, dateobs, *args):
+    return '/'.join(['tag', kind, '{:%Y%m%dT%H%M%S}'.format(dateobs)] + [
+        urllib.parse.quote(str(arg), safe='') for arg in args])
+
+
+def _cache_tag_versions(tags):
+    """Get the current version of each cache tag, assigning a new version to
+    any tag that does not have one."""
+    versions = cache.get_many(*tags)
+    for i, (tag, version) in enumerate(zip(tags, versions)):
+        if version is None:
+            cache.add(tag, uuid.uuid4().hex, timeout=0)
+            versions[i] = cache.get(tag)
+    return versions
+
+
+def cached_by_tags(*kinds):
+    """Cache the response of a view function until the event, plans, or
+    localizations on which it depends change.
+
+    The response is cached under a key made from the request path, the query
+    string, and the current versions of the view's cache tags. Calling
+    :func:`invalidate_cache` assigns new versions to the tags, so that
+    subsequent requests miss the cache. The stale entries simply expire.
+
+    Parameters
+    ----------
+    kinds : str
+        Kinds of cache tags (keys of :data:`CACHE_TAGS`). The arguments of
+        each tag are taken from the view arguments, or else from the query
+        string.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            args = dict(request.args.items(), **kwargs)
+            tags = [_cache_tag(kind, *(args.get(key)
+                                       for key in CACHE_TAGS[kind]))
+                    for kind in kinds]
+            key = '/'.join(
+                ['view', request.full_path] + _cache_tag_versions(tags))
+            rv = cache.get(key)
+            if rv is None:
+                rv = make_response(func(**kwargs))
+                # Compute validators once, for use by conditional().
+                rv.add_etag()
+                rv.last_modified = datetime.datetime.utcnow()
+                cache.set(key, rv)
+            return rv
+        return wrapper
+    return decorator
+
+
+def conditional(max_age=0, private=False):
+    """Support conditional GET requests for a view function.
+
+    Give successful responses a strong ETag that is a hash of the response
+    body, unless they already have one, and Cache-Control headers. Respond
+    with status 304 and no body if the client's copy is still current.
+
+    Parameters
+    ----------
+    max_age : int
+        Number of seconds for which the response may be reused without
+        revalidating it. If zero, then caches must revalidate every time.
+    private : bool
+        If true, then only the user's browser and not shared caches may store
+        the response.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rv = make_response(func(*args, **kwargs))
+            if rv.status_code != 200:
+                return rv
+            rv.add_etag(overwrite=False)
+            if private:
+                rv.cache_control.private = True
+            else:
+                rv.cache_control.public = True
+            if max_age:
+                rv.cache_control.max_age = max_age
+            else:
+                rv.cache_control.no_cache = True
+            return rv.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+def invalidate_cache(dateobs, telescope=None, plan_name=None,
+                     localization_name=None):
+    """Discard the cached views that depend on an event, and on one of its
+    plans or localizations.
+
+    Parameters
+    ----------
+    dateobs : datetime.datetime
+        The event time.
+    telescope, plan_name : str, optional
+        The plan that changed.
+    localization_name : str, optional
+        The localization that changed.
+    """
+    tags = [_cache_tag('event', dateobs)]
+    if plan_name is not None:
+        tags.append(_cache_tag('plan', dateobs, telescope, plan_name))
+    if localization_name is not None:
+        tags.append(_cache_tag('localization', dateobs, localization_name))
+    cache.set_many({tag: uuid.uuid4().hex for tag in tags}, timeout=0)
+
 
 def one_or_404(query):
     # FIXME: https://github.com/mitsuhiko/flask-sqlalchemy/pull/527
@@ -153,59 +266,18 @@ class DeleteForm(ModelForm):
 @login_required
 def queue():
 
-    r = requests.get(urllib.parse.urljoin(tasks.scheduler.ZTF_URL,
-                                          'queues'), json={})
-    data_all = r.json()
-    queue_names_list = []
-    for data in data_all:
-        queue_names_list.append(data['queue_name'])
-    queue_names = "\n".join(queue_names_list)
-
-    r = requests.get(
-        urllib.parse.urljoin(tasks.scheduler.ZTF_URL, 'current_queue'))
-    data = r.json()
-    queue_info = []
-    queue_info.append('Current queue information:')
-    queue_info.append(f"   Queue name: {data['queue_name']}")
-    queue_info.append(f"   Queue type: {data['queue_type']}")
-    queue = pd.read_json(data['queue'], orient='records')
-    queue_info.append(f"   Number of queued requests: {len(queue)}")
-    if len(queue) > 0:
-        n_fields = len(queue['field_id'].unique())
-        queue_info.append(f"   Number of unique field_ids: {n_fields}")
-        w = queue['ordered']
-        if np.sum(w) > 0:
-            queue_info.append("   Ordered requests:")
-            queue_info.append(queue.loc[w, ['field_id', 'ra', 'dec',
-                                            'filter_id', 'program_id',
-                                            'subprogram_name']].to_string())
-        queue_info.append("   Unordered requests:")
-        if 'slot_start_time' in queue.columns:
-            grp = queue[~w].groupby('slot_start_time')
-            for start_time, rows in grp:
-                queue_info.append(f"      {start_time}:")
-
-                rowstr = rows.to_csv(header=False,
-                                     columns=('field_id', 'ra', 'dec',
-                                              'filter_id', 'program_id',
-                                              'subprogram_name'))
-                queue_info = queue_info + rowstr.split("\n")
-            pass
-        else:
-            queue_info.append(queue.loc[~w, ['field_id', 'ra', 'dec',
-                                             'filter_id', 'program_id',
-                                             'subprogram_name']].to_string())
-    queue_info = "\n".join(queue_info)
+    snapshot = tasks.scheduler.get_ztf_queue()
 
     form = DeleteForm(request.form)
     form.queue_name.choices = [
-        (queue_name,) * 2 for queue_name in queue_names_list]
+        (queue_name,) * 2 for queue_name in snapshot['queue_names']]
 
     if request.method == 'POST' and form.validate():
         queue_name = form.queue_name.data
-        r = requests.delete(
+        requests.delete(
             urllib.parse.urljoin(tasks.scheduler.ZTF_URL, 'queues'),
             json={'queue_name': queue_name})
+        tasks.scheduler.refresh_ztf_queue()
 
         flash('Deleted observing plan "{}".'.format(queue_name),
               'success')
@@ -214,8 +286,9 @@ def queue():
     return render_template(
         'queue.html',
         form=form,
-        queue_names=queue_names,
-        queue_info=queue_info)
+        snapshot_time=snapshot['time'],
+        queue_names="\n".join(snapshot['queue_names']),
+        queue_info=snapshot['queue_info'])
 
 
 @app.route('/event/<datetime:dateobs>')
@@ -245,133 +318,59 @@ OBJECTS_COLUMNS = ['name', 'ra', 'dec', 'classification', 'redshift',
                    'first_detection_magerr', '2D CL', '2D pdf']
 
 
-def _getattr_or_masked(collection, key):
-    value = getattr(collection, key)
-    if value is None:
-        value = np.ma.masked
-    return value
-
-
 @app.route('/event/<datetime:dateobs>/objects/json')
 @login_required
 def objects_data(dateobs):
     event = models.Event.query.get_or_404(dateobs)
-    table = Table(rows=[(*(_getattr_or_masked(row, key)
-                           for key in OBJECTS_COLUMNS[:-2]),
-                         np.ma.masked, np.ma.masked)
-                        for row in models.Candidate.query],
-                  names=OBJECTS_COLUMNS)
-
-    # Populate 2D and 3D credible levels.
     localization_name = request.args.get('search[value]')
     localization = (
         models.Localization.query.filter_by(
             dateobs=event.dateobs,
             localization_name=localization_name
         ).one_or_none() or event.localizations[-1])
-    results = crossmatch(
-        localization.table,
-        SkyCoord(table['ra'] * u.deg, table['dec'] * u.deg))
-    table['2D CL'] = np.ma.masked_invalid(results.searched_prob) * 100
-    table['2D pdf'] = np.ma.masked_invalid(results.probdensity)
-
-    # Make first detection time column filterable
-    table['first_detection_time'] = table['first_detection_time'].astype(str)
-
-    result = {}
-
-    # Populate total number of records.
-    result['recordsTotal'] = len(table)
-
-    # Populate draw counter.
-    try:
-        value = int(request.args['draw'])
-    except KeyError:
-        pass
-    except ValueError:
-        abort(400)
-    else:
-        result['draw'] = value
-
-    for i in range(len(table.columns)):
-        try:
-            value = json.loads(
-                request.args['columns[{}][search][value]'.format(i)] or '{}'
-            )
-        except (KeyError, ValueError):
-            pass
-        else:
-            try:
-                value2, = np.asarray(
-                    [value['min']], dtype=table[table.colnames[i]].dtype)
-            except KeyError:
-                pass
-            except ValueError:
-                abort(400)
-            else:
-                table = table[table[table.colnames[i]] >= value2]
-
-            try:
-                value2, = np.asarray(
-                    [value['max']], dtype=table[table.colnames[i]].dtype)
-            except (KeyError, ValueError):
-                pass
-            else:
-                table = table[table[table.colnames[i]] <= value2]
 
-        try:
-            value = int(request.args['order[{}][column]'.format(i)])
-        except (KeyError, ValueError):
-            pass
-        else:
-            table.sort(table.colnames[value])
-
-        try:
-            value = request.args['order[{}][dir]'.format(i)]
-        except (KeyError, ValueError):
-            pass
-        else:
-            if value == 'desc':
-                table.reverse()
-
-    # Populate total number of filtered records.
-    result['recordsFiltered'] = len(table)
-
-    # Trim results by requested start index.
-    try:
-        value = int(request.args['start'])
-    except KeyError:
-        pass
-    except ValueError:
-        abort(400)
-    else:
-        table = table[value:]
+    # Crossmatch any candidates that are new since the last request in the
+    # background, only once even if there are many requests. Until then,
+    # their credible levels are blank.
+    if models.db.session.query(
+            models.CandidateCrossmatch.missing(localization).exists()
+    ).scalar() and cache.add('crossmatch_candidates/{}'.format(
+            localization._cache_key()), True, timeout=60):
+        tasks.skymaps.crossmatch_candidates.delay(
+            localization.localization_name, localization.dateobs)
+
+    # Select the first detection of each candidate and its stored
+    # crossmatch, and let the database filter, sort, and page through them.
+    photometry = models.CandidatePhotometry
+    crossmatch = models.CandidateCrossmatch
+    candidate = models.Candidate
+    first_detection = models.db.select([
+        photometry.dateobs, photometry.mag, photometry.magerr
+    ]).where(
+        photometry.name == candidate.name
+    ).order_by(
+        photometry.dateobs
+    ).limit(1).correlate(candidate.__table__).lateral()
+    query = models.db.session.query(candidate).outerjoin(
+        first_detection, models.db.true()
+    ).outerjoin(
+        crossmatch,
+        (crossmatch.name == candidate.name) &
+        (crossmatch.dateobs == localization.dateobs) &
+        (crossmatch.localization_name == localization.localization_name)
+    )
+    columns = [
+        candidate.name, candidate.ra, candidate.dec,
+        candidate.classification, candidate.redshift, candidate.iauname,
+        first_detection.c.dateobs, first_detection.c.mag,
+        first_detection.c.magerr,
+        crossmatch.searched_prob * 100, crossmatch.probdensity]
 
-    # Trim results by requested length.
     try:
-        value = int(request.args['length'])
-    except KeyError:
-        pass
+        result = datatables.process_query(
+            query, columns, request.args, order_by=[candidate.name])
     except ValueError:
         abort(400)
-    else:
-        table = table[:value]
-
-    result['data'] = list(
-        zip(
-            *(
-                (
-                    None if item == '--' else item
-                    for item in table.formatter._pformat_col_iter(
-                        column, max_lines=-1, show_name=False,
-                        show_unit=False, outs={}
-                    )
-                )
-                for column in table.columns.values()
-            )
-        )
-    )
-
     return jsonify(result)
 
 
@@ -412,6 +411,8 @@ def plan(dateobs):
                     dateobs=dateobs, telescope=telescope, plan_name=plan_name
                 ).delete()
             models.db.session.commit()
+            for telescope, plan_name in plans:
+                invalidate_cache(dateobs, telescope, plan_name)
             flash('Deleted plans.', 'success')
 
         if command == 'go':
@@ -431,7 +432,7 @@ def plan(dateobs):
 
 
 @app.route('/event/<datetime:dateobs>/localization/<localization_name>/plan/telescope/<telescope>/<plan_name>/gcn')  # noqa: E501
-@cache.cached()
+@cached_by_tags('plan', 'localization')
 def create_gcn_template(dateobs, telescope, localization_name, plan_name):
 
     authors = ["Fred Zwicky", "Albert Einstein"]
@@ -451,7 +452,8 @@ def create_gcn_template(dateobs, telescope, localization_name, plan_name):
 
 
 @app.route('/event/<datetime:dateobs>/plan/download/telescope/<telescope>/<plan_name>.json')  # noqa: E501
-@cache.cached()
+@conditional()
+@cached_by_tags('plan')
 def download_json(dateobs, telescope, plan_name):
 
     plan = one_or_404(models.Plan.query.filter_by(
@@ -478,7 +480,8 @@ def download_json(dateobs, telescope, plan_name):
 
 
 @app.route('/event/<datetime:dateobs>/plan/telescope/<telescope>/<plan_name>/json')  # noqa: E501
-@cache.cached()
+@conditional()
+@cached_by_tags('plan')
 def plan_json(dateobs, telescope, plan_name):
     plan = one_or_404(models.Plan.query.filter_by(
         dateobs=dateobs, telescope=telescope, plan_name=plan_name))
@@ -491,7 +494,7 @@ def plan_json(dateobs, telescope, plan_name):
 
 
 @app.route('/event/<datetime:dateobs>/plan/telescope/<telescope>/<plan_name>/prob')  # noqa: E501
-@cache.cached()
+@cached_by_tags('plan', 'localization')
 def prob_json(dateobs, telescope, plan_name):
     localization_name = request.args.get('localization_name')
     plan = one_or_404(models.Plan.query.filter_by(
@@ -504,11 +507,36 @@ def prob_json(dateobs, telescope, plan_name):
     return jsonify(prob)
 
 
+@app.route('/event/<datetime:dateobs>/plan/prob')
+@cached_by_tags('event')
+def plans_prob_json(dateobs):
+    """Get the area and the enclosed probability of every localization for
+    every plan of an event."""
+    plans = models.Plan.query.filter(
+        models.Plan.dateobs == dateobs,
+        models.Plan.status != models.Plan.Status.WORKING
+    ).order_by(models.Plan.telescope, models.Plan.plan_name).all()
+    localizations = models.Localization.query.filter_by(dateobs=dateobs).all()
+
+    matrix = models.Plan.get_coverage_matrix(plans)
+    area = matrix.getnnz(axis=1) * hp.nside2pixarea(
+        models.Localization.nside, degrees=True)
+    probs = {localization.localization_name: matrix @ localization.flat_2d
+             for localization in localizations}
+
+    return jsonify([
+        dict(telescope=plan.telescope,
+             plan_name=plan.plan_name,
+             area=float(area[i]),
+             prob={key: float(value[i]) for key, value in probs.items()})
+        for i, plan in enumerate(plans)])
+
+
 class PlanForm(ModelForm):
 
     class Meta:
         model = models.Plan
-        exclude = ['plan_args']
+        exclude = ['plan_args', 'timings', 'summary']
 
     dateobs = DateTimeField()
 
@@ -841,7 +869,7 @@ def localization_post(dateobs, localization_name):
         except KeyError:
             return None
         else:
-            return col.tolist()
+            return np.asarray(col)
 
     models.db.session.add(
         models.Localization(
@@ -854,7 +882,14 @@ def localization_post(dateobs, localization_name):
             distnorm=get_col(skymap, 'DISTNORM')))
 
     models.db.session.commit()
-    tasks.skymaps.contour.delay(localization_name, dateobs)
+    invalidate_cache(dateobs, localization_name=localization_name)
+    (
+        tasks.skymaps.warm_flat_cache.s(localization_name, dateobs) | group(
+            tasks.skymaps.contour.s(dateobs),
+            tasks.skymaps.crossmatch_galaxies.s(dateobs),
+            tasks.skymaps.render_plots.s(dateobs)
+        )
+    ).delay()
     return '', 201
 
 
@@ -866,29 +901,36 @@ def localization_observability(dateobs, localization_name):
         localization_name=localization_name, date=datetime.date.today()))
 
 
+def _send_plot(localization, plot, date):
+    """Serve a plot that was rendered by tasks.skymaps.render_plots.
+
+    If the plot is not ready yet, then start rendering it and respond with
+    status 202 and a placeholder image.
+    """
+    filename = localization._plot_cache_filename(plot, date)
+    if os.path.exists(filename):
+        return send_file(filename, mimetype='image/png')
+
+    # Schedule rendering only once, even if there are many requests.
+    if cache.add('render_plots/{}/{}'.format(
+            localization._cache_key(), date.isoformat()), True, timeout=600):
+        tasks.skymaps.render_plots.delay(
+            localization.localization_name, localization.dateobs, [date])
+
+    response = app.send_static_file('rendering.svg')
+    response.status_code = 202
+    response.headers['Retry-After'] = '10'
+    response.cache_control.no_store = True
+    return response
+
+
 @app.route('/event/<datetime:dateobs>/observability/-/<localization_name>/<date:date>/observability.png')  # noqa: E501
 @login_required
-@cache.cached()
 def localization_observability_for_date(dateobs, localization_name, date):
     localization = one_or_404(
         models.Localization.query
         .filter_by(dateobs=dateobs, localization_name=localization_name))
-    names, lons, lats, heights = zip(*(
-        (t.telescope, str(t.lon), str(t.lat), str(t.elevation))
-        for t in models.Telescope.query))
-    with \
-            tempfile.NamedTemporaryFile(suffix='.fits') as fitsfile, \
-            tempfile.NamedTemporaryFile(suffix='.png') as imgfile, \
-            matplotlib.style.context('default'):
-        io.write_sky_map(fitsfile.name, localization.table_2d, moc=True)
-        plot_observability(['--site-name', *names,
-                            '--site-longitude', *lons,
-                            '--site-latitude', *lats,
-                            '--site-height', *heights,
-                            '--time', date.isoformat(),
-                            fitsfile.name, '-o', imgfile.name])
-        contents = imgfile.read()
-    return Response(contents, mimetype='image/png')
+    return _send_plot(localization, 'observability', date)
 
 
 @app.route('/event/<datetime:dateobs>/observability/<telescope>/<localization_name>/-/airmass.png')  # noqa: E501
@@ -901,30 +943,18 @@ def localization_airmass(dateobs, telescope, localization_name):
 
 @app.route('/event/<datetime:dateobs>/observability/<telescope>/<localization_name>/<date:date>/airmass.png')  # noqa: E501
 @login_required
-@cache.cached()
 def localization_airmass_for_date(dateobs, telescope, localization_name, date):
     localization = one_or_404(
         models.Localization.query
         .filter_by(dateobs=dateobs, localization_name=localization_name))
     telescope = models.Telescope.query.get_or_404(telescope)
-    with \
-            tempfile.NamedTemporaryFile(suffix='.fits') as fitsfile, \
-            tempfile.NamedTemporaryFile(suffix='.png') as imgfile, \
-            matplotlib.style.context('default'):
-        io.write_sky_map(fitsfile.name, localization.table_2d, moc=True)
-        plot_airmass(['--site-longitude', str(telescope.lon),
-                      '--site-latitude', str(telescope.lat),
-                      '--site-height', str(telescope.elevation),
-                      '--site-timezone', telescope.timezone,
-                      '--time', date.isoformat(),
-                      fitsfile.name, '-o', imgfile.name])
-        contents = imgfile.read()
-    return Response(contents, mimetype='image/png')
+    return _send_plot(localization, 'airmass_' + telescope.telescope, date)
 
 
 @app.route('/event/<datetime:dateobs>/localization/<localization_name>/json')
 @login_required
-@cache.cached()
+@conditional(private=True)
+@cached_by_tags('localization')
 def localization_json(dateobs, localization_name):
     localization = one_or_404(
         models.Localization.query
@@ -945,7 +975,6 @@ def nan_to_none(o):
 @login_required
 def galaxies_data(dateobs):
     event = models.Event.query.get_or_404(dateobs)
-    table = catalogs.galaxies.copy()
 
     # Populate 2D and 3D credible levels.
     localization_name = request.args.get('search[value]')
@@ -954,108 +983,21 @@ def galaxies_data(dateobs):
             dateobs=event.dateobs,
             localization_name=localization_name
         ).one_or_none() or event.localizations[-1])
-    results = crossmatch(
-        localization.table,
-        SkyCoord(table['ra'], table['dec'], table['distmpc']))
-    table['2D CL'][:] = np.ma.masked_invalid(results.searched_prob) * 100
-    table['3D CL'][:] = np.ma.masked_invalid(results.searched_prob_vol) * 100
-    table['2D pdf'][:] = np.ma.masked_invalid(results.probdensity)
-    table['3D pdf'][:] = np.ma.masked_invalid(results.probdensity_vol)
-
-    result = {}
+    results = catalogs.get_crossmatch(localization)
+    table = catalogs.galaxies
+    columns = dict(table.columns)
+    for name, key, scale in [('2D CL', 'searched_prob', 100),
+                             ('3D CL', 'searched_prob_vol', 100),
+                             ('2D pdf', 'probdensity', 1),
+                             ('3D pdf', 'probdensity_vol', 1)]:
+        columns[name] = MaskedColumn(
+            np.ma.masked_invalid(results[key]) * scale,
+            format=table[name].format)
 
-    # Populate total number of records.
-    result['recordsTotal'] = len(table)
-
-    # Populate draw counter.
     try:
-        value = int(request.args['draw'])
-    except KeyError:
-        pass
+        result = datatables.process(columns.values(), request.args)
     except ValueError:
         abort(400)
-    else:
-        result['draw'] = value
-
-    for i in range(len(table.columns)):
-        try:
-            value = json.loads(
-                request.args['columns[{}][search][value]'.format(i)] or '{}'
-            )
-        except (KeyError, ValueError):
-            pass
-        else:
-            try:
-                value2, = np.asarray(
-                    [value['min']], dtype=table[table.colnames[i]].dtype)
-            except KeyError:
-                pass
-            except ValueError:
-                abort(400)
-            else:
-                table = table[table[table.colnames[i]] >= value2]
-
-            try:
-                value2, = np.asarray(
-                    [value['max']], dtype=table[table.colnames[i]].dtype)
-            except (KeyError, ValueError):
-                pass
-            else:
-                table = table[table[table.colnames[i]] <= value2]
-
-        try:
-            value = int(request.args['order[{}][column]'.format(i)])
-        except (KeyError, ValueError):
-            pass
-        else:
-            table.sort(table.colnames[value])
-
-        try:
-            value = request.args['order[{}][dir]'.format(i)]
-        except (KeyError, ValueError):
-            pass
-        else:
-            if value == 'desc':
-                table.reverse()
-
-    # Populate total number of filtered records.
-    result['recordsFiltered'] = len(table)
-
-    # Trim results by requested start index.
-    try:
-        value = int(request.args['start'])
-    except KeyError:
-        pass
-    except ValueError:
-        abort(400)
-    else:
-        table = table[value:]
-
-    # Trim results by requested length.
-    try:
-        value = int(request.args['length'])
-    except KeyError:
-        pass
-    except ValueError:
-        abort(400)
-    else:
-        table = table[:value]
-
-    result['data'] = list(
-        zip(
-            *(
-                (
-                    None if item == '--' else item
-                    for item in table.formatter._pformat_col_iter(
-                        column, max_lines=-1, show_name=False,
-                        show_unit=False, outs={}
-                    )
-                )
-                for column in table.columns.values()
-            )
-        )
-    )
-
     return jsonify(result)
 
 
@@ -1069,9 +1011,13 @@ def galaxies(dateobs):
 
 def get_queue_transient_name(plan):
 
-    event = models.Event.query.filter_by(dateobs=plan.dateobs).one()
-    gcn_notice = event.gcn_notices[-1]
-    stream = gcn_notice.stream
+    stream = models.db.session.query(
+        models.GcnNotice.stream
+    ).filter_by(
+        dateobs=plan.dateobs
+    ).order_by(
+        models.GcnNotice.date.desc()
+    ).limit(1).scalar()
 
     queue_name = "{0}_{1}_{2}_{3}".format(
         str(plan.dateobs).replace(" ", "-"),
@@ -1110,21 +1056,26 @@ def get_json_data_manual(form):
     bands = {'g': 1, 'r': 2, 'i': 3, 'z': 4, 'J': 5}
     json_data = {'queue_name': "ToO_" + queue_name,
                  'validity_window_mjd': [start_mjd, end_mjd]}
+    fields = models.Field.get_coverage(telescope)
+    rows = fields.find(field_ids)
+    if np.any(rows < 0):
+        abort(404)
+
     targets = []
     cnt = 1
     for filt in filters:
         filter_id = bands[filt]
-        for field_id in field_ids:
-            field = one_or_404(models.Field.query.filter_by(
-                telescope=telescope, field_id=field_id))
-            if doReferences and filter_id not in field.reference_filter_ids:
-                continue
-
+        if doReferences:
+            has_reference = fields.has_reference(rows, filter_id)
+        else:
+            has_reference = np.ones(len(rows), dtype=bool)
+        for field_id, row in zip(np.asarray(field_ids)[has_reference],
+                                 rows[has_reference]):
             target = {'request_id': cnt,
                       'program_id': program_id,
-                      'field_id': field_id,
-                      'ra': field.ra,
-                      'dec': field.dec,
+                      'field_id': int(field_id),
+                      'ra': float(fields.ra[row]),
+                      'dec': float(fields.dec[row]),
                       'filter_id': filter_id,
                       'exposure_time': exposure_time,
                       'program_pi': program_pis[telescope] + '/' + username,
@@ -1169,11 +1120,32 @@ def get_json_data_manual(form):
     return json_data, queue_name
 
 
+def get_plan_exposures(plan):
+    """Get the field ID, position, filter ID, exposure time, and reference
+    filter IDs of each planned observation of a plan, in order of observation
+    time, in a single query."""
+    PlannedObservation = models.PlannedObservation
+    Field = models.Field
+    return models.db.session.query(
+        PlannedObservation.field_id, Field.ra, Field.dec,
+        PlannedObservation.filter_id, PlannedObservation.exposure_time,
+        Field.reference_filter_ids
+    ).join(
+        PlannedObservation.field
+    ).filter(
+        PlannedObservation.dateobs == plan.dateobs,
+        PlannedObservation.telescope == plan.telescope,
+        PlannedObservation.plan_name == plan.plan_name
+    ).order_by(
+        PlannedObservation.obstime
+    ).all()
+
+
 def get_json_data(plan, decam_style=True):
 
     queue_name, transient_name = get_queue_transient_name(plan)
 
-    exposures = plan.planned_observations
+    exposures = get_plan_exposures(plan)
     telescope = plan.telescope
     doReferences = plan.plan_args["doReferences"]
     doDither = plan.plan_args["doDither"]
@@ -1193,46 +1165,26 @@ def get_json_data(plan, decam_style=True):
     # add a little buffer
     end_mjd = (end_mjd + 30.0 * u.min).mjd
 
-    if doReferences:
-        json_data = {
-            'queue_name': "ToO_"+queue_name,
-            'validity_window_mjd': [start_mjd, end_mjd],
-            'targets': [
-                {
-                    'request_id': ii,
-                    'program_id': plan.program_id,
-                    'field_id': exposure.field_id,
-                    'ra': exposure.field.ra,
-                    'dec': exposure.field.dec,
-                    'filter_id': exposure.filter_id,
-                    'exposure_time': exposure.exposure_time/ditherNorm,
-                    'program_pi': program_pis[telescope],
-                    'subprogram_name': "ToO_"+transient_name
-                }
-                for ii, exposure in enumerate(exposures)
-                if exposure.filter_id in
-                exposure.field.reference_filter_ids
-            ]
-        }
-    else:
-        json_data = {
-            'queue_name': "ToO_"+queue_name,
-            'validity_window_mjd': [start_mjd, end_mjd],
-            'targets': [
-                {
-                    'request_id': ii,
-                    'program_id': plan.program_id,
-                    'field_id': exposure.field_id,
-                    'ra': exposure.field.ra,
-                    'dec': exposure.field.dec,
-                    'filter_id': exposure.filter_id,
-                    'exposure_time': exposure.exposure_time/ditherNorm,
-                    'program_pi': program_pis[telescope],
-                    'subprogram_name': "ToO_"+transient_name
-                }
-                for ii, exposure in enumerate(exposures)
-            ]
-        }
+    json_data = {
+        'queue_name': "ToO_"+queue_name,
+        'validity_window_mjd': [start_mjd, end_mjd],
+        'targets': [
+            {
+                'request_id': ii,
+                'program_id': plan.program_id,
+                'field_id': field_id,
+                'ra': ra,
+                'dec': dec,
+                'filter_id': filter_id,
+                'exposure_time': exposure_time/ditherNorm,
+                'program_pi': program_pis[telescope],
+                'subprogram_name': "ToO_"+transient_name
+            }
+            for ii, (field_id, ra, dec, filter_id, exposure_time,
+                     reference_filter_ids) in enumerate(exposures)
+            if not doReferences or filter_id in reference_filter_ids
+        ]
+    }
 
     if (telescope == "DECam") and decam_style:
         decam_dicts = []
@@ -1276,6 +1228,7 @@ def get_filters_string(telescopes):
 
 
 @app.route('/telescope/<telescope>/field/<int:field_id>/json')
+@conditional(max_age=86400)
 def field_json(telescope, field_id):
     field = one_or_404(models.Field.query.filter_by(
         telescope=telescope, field_id=field_id))